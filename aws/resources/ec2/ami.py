@@ -0,0 +1,112 @@
+import os, json, time
+
+from aws.utils.clients import paginate
+from aws.utils.state import FileLock, atomicWrite
+from aws.utils.utils import getCachePath
+
+
+# default number of seconds a resolved ami id is re-used for
+AMI_CACHE_TTL_SECONDS = 86400
+
+# get path of the ami resolution cache file (under cache.directory in config.yaml)
+def getAmiCachePath(g):
+    return getCachePath(g, 'ami.json')
+
+# cache key: every value the describe_images filters depend on
+def getAmiCacheKey(g):
+    server = g['config']['server']
+    return '|'.join([
+        g['config']['region'],
+        server['ami_type'],
+        server['architecture'],
+        server['virtualization_type'],
+        server['volumes'][0]['device'],
+        server['root_device_type']
+    ])
+
+# read the cache file ({} if there is none or it is unreadable)
+def readAmiCache(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as handle:
+            return json.load(handle)
+    except ValueError:
+        return {}
+
+# get cached ami id for key, if it is younger than the ttl
+def getCachedAMI(g, path, key):
+    ttl = g['config'].get('cache', {}).get('ami_ttl_seconds', AMI_CACHE_TTL_SECONDS)
+    entry = readAmiCache(path).get(key)
+    if entry and time.time() - entry['cached_at'] < ttl:
+        return entry['image_id']
+    return None
+
+# store resolved ami id for key
+def cacheAMI(path, key, image):
+    with FileLock(path):
+        cache = readAmiCache(path)
+        cache[key] = {
+            'image_id': image['ImageId'],
+            'creation_date': image['CreationDate'],
+            'cached_at': time.time()
+        }
+        atomicWrite(path, json.dumps(cache, indent=4, sort_keys=True))
+
+# Stream describe_images pages and keep only the newest image (by CreationDate).
+def findLatestImage(g):
+    config = g['config']
+    ec2_client = g['clients'].client('ec2')
+
+    filters = [
+        {
+            'Name': 'name',
+            'Values': [config['server']['ami_type']+'*']
+        },
+        {
+            'Name': 'architecture',
+            'Values': [config['server']['architecture']]
+        },
+        {
+            'Name': 'virtualization-type',
+            'Values': [config['server']['virtualization_type']]
+        },
+        {
+            'Name': 'root-device-name',
+            'Values': [config['server']['volumes'][0]['device']]
+        },
+        {
+            'Name': 'root-device-type',
+            'Values': [config['server']['root_device_type']]
+        },
+        {
+            'Name': 'owner-alias',
+            'Values': ['amazon']
+        }
+    ]
+
+    latest = None
+    for image in paginate(ec2_client, 'describe_images', 'Images', Filters=filters):
+        if latest is None or image['CreationDate'] > latest['CreationDate']:
+            latest = image
+    return latest
+
+# Get newest AMI filtered on config values, using the on-disk resolution cache
+#  unless g['options']['refresh_ami'] is set.
+def getLatestAMI(g):
+    path = getAmiCachePath(g)
+    key = getAmiCacheKey(g)
+
+    if not g.get('options', {}).get('refresh_ami'):
+        image_id = getCachedAMI(g, path, key)
+        if image_id:
+            print('  using cached ami ' + image_id)
+            return image_id
+
+    image = findLatestImage(g)
+    if not image:
+        return None
+
+    cacheAMI(path, key, image)
+    #print(f'Latest AMI: {image["ImageId"]}')
+    return image['ImageId']
@@ -0,0 +1,85 @@
+import hashlib
+
+from botocore.exceptions import ClientError
+
+from aws.utils.utils import updateDeployed
+from aws.utils.clients import paginate
+from aws.utils.retry import getErrorCode
+from aws.resources.vpc.vpc import getTagsFromConfig
+from aws.resources.ec2.userdata.render import getUserdataPlan, getPlanHash
+
+
+### NOTE: 'deploy.py config.yaml bake' launches one instance with the full userdata,
+##    provisions it and saves it as an image. Images are recorded in the output file
+##    under baked_images as {bake hash: image id}, where the hash covers the full
+##    userdata plan and the base ami. While the hash is unchanged, createEc2Instances
+##    launches from the baked image with a trimmed userdata (see render.py).
+
+# tag holding the bake hash on baked images (also used to find them on destroy)
+BAKE_HASH_TAG = 'config-hash'
+
+# hash of everything a baked image depends on
+def getBakeHash(g, base_image_id):
+    content = getPlanHash(getUserdataPlan(g)) + '|' + base_image_id
+    return hashlib.sha256(content.encode()).hexdigest()
+
+# get {bake hash: image id} (deploy.py loads the stored ones before any phase runs)
+def getBakedImages(g):
+    return g['deployed'].get('baked_images', {})
+
+# get the baked image id for the current config (None if there is none, or it is gone)
+def findBakedImage(g, base_image_id):
+    image_id = getBakedImages(g).get(getBakeHash(g, base_image_id))
+    if image_id is None:
+        return None
+
+    images = g['clients'].client('ec2').describe_images(
+        Filters=[{'Name': 'image-id', 'Values': [image_id]}, {'Name': 'state', 'Values': ['available']}]
+    )['Images']
+    return image_id if images else None
+
+# Create an image of instance_id, wait until it is available and record it under bake_hash.
+def createBakedImage(g, instance_id, bake_hash):
+    ec2_client = g['clients'].client('ec2')
+    name = g['config']['vpc']['tags'][0]['value'] + '-baked-' + bake_hash[:16]
+
+    print('creating image ' + name + ' from ' + instance_id)
+    image_id = ec2_client.create_image(
+        InstanceId=instance_id,
+        Name=name,
+        Description='baked by deploy.py from config hash ' + bake_hash,
+        TagSpecifications=[{
+            'ResourceType': 'image',
+            'Tags': getTagsFromConfig(g['config']['vpc']['tags']) + [{'Key': BAKE_HASH_TAG, 'Value': bake_hash}]
+        }]
+    )['ImageId']
+    ec2_client.get_waiter('image_available').wait(ImageIds=[image_id], WaiterConfig={'Delay': 15, 'MaxAttempts': 120})
+    print('image ' + image_id + ' available')
+
+    baked_images = dict(getBakedImages(g))
+    baked_images[bake_hash] = image_id
+    updateDeployed(g, {'baked_images': baked_images})
+    return image_id
+
+# deregister every baked image of this deployment (found by tags) and delete its snapshots
+def deleteBakedImages(g):
+    ec2_client = g['clients'].client('ec2')
+    name_tag = g['config']['vpc']['tags'][0]
+
+    images = paginate(ec2_client, 'describe_images', 'Images',
+        Owners=['self'],
+        Filters=[
+            {'Name': 'tag:' + name_tag['key'], 'Values': [name_tag['value']]},
+            {'Name': 'tag-key', 'Values': [BAKE_HASH_TAG]}
+        ]
+    )
+    for image in images:
+        print('deregistering baked image ' + image['ImageId'])
+        ec2_client.deregister_image(ImageId=image['ImageId'])
+        for mapping in image.get('BlockDeviceMappings', []):
+            if 'SnapshotId' in mapping.get('Ebs', {}):
+                try:
+                    ec2_client.delete_snapshot(SnapshotId=mapping['Ebs']['SnapshotId'])
+                except ClientError as e:
+                    if getErrorCode(e) != 'InvalidSnapshot.NotFound':
+                        raise
@@ -1,40 +1,55 @@
-import os, time
-import traceback, sys
+import os
+import sys
 from pprint import pprint
-from operator import attrgetter
+
+from botocore.exceptions import ClientError
 
 from aws.resources.iam.iam import createInstanceProfile
-from aws.resources.vpc.vpc import getSubnetsByTag
-from aws.resources.ec2.userdata.userdata import getUserdataFromTemplate
+from aws.resources.ec2.userdata.render import getUserdata
+from aws.resources.ec2.inventory import getInventory
+from aws.resources.ec2.ami import getLatestAMI
+from aws.resources.ec2.provision import provisionHosts
+from aws.resources.ec2.template import useLaunchTemplate, getLaunchTemplateData, ensureLaunchTemplate
+from aws.resources.ec2.bake import getBakeHash, findBakedImage, createBakedImage
+from aws.resources.ec2.pool import getWarmPoolSize, getPoolTags, takePooledInstances, refillWarmPool
+from aws.resources.ec2.placement import placeInstances
 
-from aws.utils.utils import updateDeployed
+from aws.utils.utils import updateDeployed, startBackgroundTask
+from aws.utils.clients import paginateFilterValues
+from aws.utils.retry import retryWithBackoff, getErrorCode, getErrorMessage
 
+# get running instances in the deployed vpc (inventory records) and their count
+#  (warm pool instances are not counted, see pool.py)
 def getRunningInstances(g):
-    ec2_client = g['session'].client('ec2')
-    ec2_resource = g['session'].resource('ec2')
-
-    # check for existing ec2 instances
-    # get instances that are running in vpc
-    filters = [
-        {"Name": "instance-state-name", "Values": ["running"]},
-        {"Name": "vpc-id", "Values": [g['deployed']['vpc_id']]},
-    ]
-
-    # add instances to list
-    ec2_instances = ec2_client.describe_instances(Filters=filters)
-    instance_ids = []
-    for reservation in ec2_instances["Reservations"]:
-        instance_ids += [instance["InstanceId"] for instance in reservation["Instances"]]
-    
-    return ec2_resource.instances.filter(
-        InstanceIds=instance_ids,
-    ), len(instance_ids)
+    inventory = getInventory(g, g['deployed']['vpc_id'], ['running'])
+    records = [record for record in inventory.records if record.pool_state != 'pooled']
+    return records, len(records)
+
+# Describe the volumes attached to instance_ids with a single paginated describe_volumes
+#  (filter values are sent in chunks, see aws/utils/clients.py), indexed by instance id.
+def getVolumesByInstance(g, instance_ids):
+    ec2_client = g['clients'].client('ec2')
+
+    volumes_by_instance = {}
+    for instance_id in instance_ids:
+        volumes_by_instance[instance_id] = []
+
+    for volume in paginateFilterValues(ec2_client, 'describe_volumes', 'Volumes', 'attachment.instance-id', instance_ids):
+        for attachment in volume['Attachments']:
+            if attachment['InstanceId'] in volumes_by_instance:
+                volumes_by_instance[attachment['InstanceId']].append({
+                    'volume_id': volume['VolumeId'],
+                    'size': volume['Size'],
+                    'type': volume['VolumeType'],
+                    'device': attachment['Device'],
+                    'state': attachment['State']
+                })
+    return volumes_by_instance
 
 def updateEC2Deployed(g, instances):
     config = g['config']
     deployed = g['deployed']
-    ec2_client = g['session'].client('ec2')
-    ec2_resource = g['session'].resource('ec2')
+    ec2_resource = g['clients'].resource('ec2')
     changes = {}
 
     path = config['ssh_keys']['directory'] + os.sep
@@ -45,6 +60,7 @@ def updateEC2Deployed(g, instances):
     changes['ec2_instances'] = []
     for inst in instances:
         ec2data = {}
+        ec2data['id'] = inst.id
         ec2data['public_dns'] = inst.public_dns_name
         ec2data['ssh'] = []
         ec2data['ssh'].append('ssh -i ' + path + keyfile + " " + admin_user + '@' + inst.public_dns_name)
@@ -52,63 +68,100 @@ def updateEC2Deployed(g, instances):
             ec2data['ssh'].append('ssh -i ' + path + users['login'] + '-key.pem' + " " + users['login'] + '@' + inst.public_dns_name)
         changes['ec2_instances'].append(ec2data)
 
-        changes['subnets'] = {}
-    # iterate over subnets and update output file volume data per instance
+    # one (paginated) describe_volumes for all instances, indexed by instance id
+    volumes_by_instance = getVolumesByInstance(g, [inst.id for inst in instances])
+
+    # index instances by subnet and write volume data per instance
+    changes['subnets'] = {}
     for sn_id in deployed['subnets']:
         changes['subnets'][sn_id] = {}
-        
-        for inst in instances:
-            if sn_id == inst.subnet_id:
-                changes['subnets'][sn_id][inst.id] = {}
-                changes['subnets'][sn_id][inst.id]['public_dns'] = inst.public_dns_name
-                
-                for v in inst.volumes.all():
-                    volume_details = ec2_client.describe_volumes(
-                        VolumeIds=[
-                            v.volume_id
-                        ]
-                    )
-                    changes['subnets'][sn_id][inst.id][v.volume_id] = []
-                    vdata = {}
-                    vdata['size'] = v.size
-                    vdata['type'] = v.volume_type
-                    vdata['device'] = volume_details['Volumes'][0]['Attachments'][0]['Device']
-                    vdata['state'] = volume_details['Volumes'][0]['Attachments'][0]['State']
-                    changes['subnets'][sn_id][inst.id][v.volume_id].append(vdata)
-        
+
+    for inst in instances:
+        if inst.subnet_id not in changes['subnets']:
+            continue
+        instance_data = {}
+        instance_data['public_dns'] = inst.public_dns_name
+        for volume in volumes_by_instance[inst.id]:
+            vdata = {}
+            vdata['size'] = volume['size']
+            vdata['type'] = volume['type']
+            vdata['device'] = volume['device']
+            vdata['state'] = volume['state']
+            instance_data[volume['volume_id']] = [vdata]
+        changes['subnets'][inst.subnet_id][inst.id] = instance_data
+
     vpc_id = g['deployed']['vpc_id']
     subnets = ec2_resource.subnets.filter(
         Filters=[{"Name": "vpc-id", "Values": [vpc_id]}]
     )
     for sn in subnets:
+        changes['subnets'].setdefault(sn.id, {})
         changes['subnets'][sn.id]['az'] = sn.availability_zone
         changes['subnets'][sn.id]['cidr'] = sn.cidr_block
 
     updateDeployed(g, changes)
 
-# Create EC2 instances from config dict and write changes to output file
-def createEc2Instances(g):
+### NOTE: a new instance profile takes a while to propagate from iam to ec2.
+##    Until it has, run_instances fails with InvalidParameterValue for the
+##    iamInstanceProfile parameter. That error is retried, anything else is fatal.
+##  See: https://forums.aws.amazon.com/thread.jspa?messageID=593651
+#
+# check if an exception is the instance profile not (yet) being visible to ec2
+def isProfilePropagationError(e):
+    if getErrorCode(e) != 'InvalidParameterValue':
+        return False
+    message = getErrorMessage(e).lower()
+    return 'iaminstanceprofile' in message or 'instance profile' in message
+
+# seconds to wait for the instance profile to propagate (server.launch.iam_propagation_timeout)
+def getPropagationTimeout(g):
+    return g['config']['server'].get('launch', {}).get('iam_propagation_timeout', 300)
+
+# run_instances, retrying (with backoff, until the propagation timeout) while the profile propagates
+def launchInstances(g, **request):
+    ec2_client = g['clients'].client('ec2')
+    return retryWithBackoff(
+        lambda: ec2_client.run_instances(**request),
+        isProfilePropagationError,
+        'run_instances',
+        deadline_seconds=getPropagationTimeout(g)
+    )
+
+# DryRun run_instances with the instance profile; DryRunOperation means the real call would succeed
+def probeInstanceProfile(g):
     config = g['config']
     deployed = g['deployed']
-    ec2_client = g['session'].client('ec2')
+    ec2_client = g['clients'].client('ec2')
 
-    instances, instance_count = getRunningInstances(g)
-    max_count = g['config']['server']['max_count']
-    # check that server.max_count is not already exceeded
-    if max_count <= instance_count:
-        print('max_count: ' + str(max_count) + ' for ec2 instances has already been reached ' + '(' + str(instance_count) + ')')
-        updateEC2Deployed(g, instances)
-        print('exiting...')
-        sys.exit(1)
+    def dryRun():
+        try:
+            ec2_client.run_instances(
+                DryRun=True,
+                InstanceType=config['server']['instance_type'],
+                ImageId=deployed['image_id'],
+                MinCount=1,
+                MaxCount=1,
+                IamInstanceProfile=deployed['instance_profile'],
+                NetworkInterfaces=[
+                    {
+                        "DeviceIndex": 0,
+                        "Groups": [deployed['sg_id']],
+                        'SubnetId': list(deployed['subnets'])[0]
+                    }
+                ]
+            )
+        except ClientError as e:
+            if getErrorCode(e) != 'DryRunOperation':
+                raise
 
-    volumes = config['server']['volumes']
+    print('waiting for instance profile to propagate to ec2')
+    retryWithBackoff(dryRun, isProfilePropagationError, 'instance profile', deadline_seconds=getPropagationTimeout(g))
+    print('instance profile usable by ec2')
 
-    initial_sudo_password = config['server']['admin']['initial_sudo_password']
-    MODIFIED_USERDATA_SCRIPT = getUserdataFromTemplate(initial_sudo_password)
-    
-    # volume configuration for ec2 instance(s)
+# volume configuration for ec2 instance(s)
+def getBlockDeviceMappings(g):
     blockDeviceMappings = []
-    for volume in volumes:
+    for volume in g['config']['server']['volumes']:
         block_device = {}
         device_type = {}
         block_device['DeviceName'] = volume['device']
@@ -117,136 +170,147 @@ def createEc2Instances(g):
         #device_type['VolumeType'] = volume['type']
         block_device['Ebs'] = device_type
         blockDeviceMappings.append(block_device)
-        
-        # mount non / volumes
-        if not volume['mount'] == '/':
-            # edit userdata script to make call to bash function
-            # TODO: utilize more robust templating instead
-            MODIFIED_USERDATA_SCRIPT += "\n" +  "formatAndMount \"" + volume['device'] + "\" \"" + volume['type'] + "\" \"" + volume['mount'] + "\""
-    
-    
-    # create admin user
-    admin_user = config['server']['admin']['login']
-    # edit userdata script to make call to bash function
-    # TODO: utilize more robust templating instead
-    MODIFIED_USERDATA_SCRIPT += "\n" + "createAdminUser \"" + admin_user + "\""
-    
-    # create non-admin users
-    for user in config['server']['users']:
-        # edit userdata script to make call to bash function
-        # TODO: utilize more robust templating instead
-        MODIFIED_USERDATA_SCRIPT += "\n" + "createRegularUser \"" + user['login'] + "\""
-    
-    # make user specific shared (read) directories on mounted volumes 
-    for user in config['server']['users']:
-        for volume in volumes:
-            if volume['mount'] != '/':
-                # edit userdata script to make call to bash function
-                # TODO: utilize more robust templating instead
-                MODIFIED_USERDATA_SCRIPT += "\n" + "makeSharedDirectory \"" + user['login'] + "\" \"" + volume['mount'] + "\" &"
-    
-    # give sudo to users configured to have it
-    for user in config['server']['users']:
-        if user['can_sudo']:
-            MODIFIED_USERDATA_SCRIPT += "\n" + "giveUserSudo \"" + user['login'] + "\" &"
-    
-    print('creating ec2 instance profile')
-    iam_instance_profile = createInstanceProfile(g)
+    return blockDeviceMappings
+
+# Launch between min_count and max_count instances of image_id with userdata, spread
+#  over the vpc subnets, and return their ids. use_template: launch from a launch template version (see template.py),
+#  tags: instance tags (eg. the warm pool state).
+def launchServers(g, image_id, userdata, min_count, max_count, use_template=False, tags=None):
+    config = g['config']
+    deployed = g['deployed']
+
+    blockDeviceMappings = getBlockDeviceMappings(g)
+
+    # instance profile may already be resolved by an earlier (concurrent) phase
+    if 'instance_profile' in deployed:
+        iam_instance_profile = deployed['instance_profile']
+    else:
+        print('creating ec2 instance profile')
+        iam_instance_profile = createInstanceProfile(g)
     
-    print('getting subnet id')
-    subnet_id = getSubnetsByTag(g)[0].id
+    # the subnet is picked per shard (see placement.py)
+    network_interface = {
+        "DeviceIndex": 0,
+        "Groups": [deployed['sg_id']],
+        'AssociatePublicIpAddress': True
+    }
+
+    # launch template mode: everything but the network interface is in the template version
+    if use_template:
+        template_id, version = ensureLaunchTemplate(g,
+            getLaunchTemplateData(g, image_id, userdata, iam_instance_profile, blockDeviceMappings))
+        launch_request = {
+            'LaunchTemplate': {'LaunchTemplateId': template_id, 'Version': str(version)}
+        }
+    else:
+        launch_request = {
+            'KeyName': config['server']['admin']['ssh_key']['name'],
+            'InstanceType': config['server']['instance_type'],
+            'ImageId': image_id,
+            'UserData': userdata,
+            'IamInstanceProfile': iam_instance_profile,
+            'BlockDeviceMappings': blockDeviceMappings
+        }
+    if tags:
+        launch_request['TagSpecifications'] = [{'ResourceType': 'instance', 'Tags': tags}]
 
+    print('creating ec2 instance(s)')
+    return placeInstances(g, launchInstances, launch_request, network_interface, min_count, max_count)
+
+# get the (base) ami id, which may already be resolved by an earlier (concurrent) phase
+def getImageId(g):
+    if 'image_id' in g['deployed']:
+        return g['deployed']['image_id']
     print('getting ami image id')
     image_id = getLatestAMI(g)
+    if not image_id:
+        raise ValueError('ImageId not found. Check filter values.')
+    return image_id
+
+# Get (image id, userdata) to launch servers with. An image baked from the current
+#  config (deploy.py bake) is preferred, with trimmed userdata.
+def getLaunchImageAndUserdata(g):
+    image_id = getImageId(g)
+    baked_image_id = findBakedImage(g, image_id)
+    if baked_image_id:
+        print('launching from baked image ' + baked_image_id)
+        image_id = baked_image_id
+
+    # render (or re-use) userdata before any launch call, so an oversized one fails early
+    return image_id, getUserdata(g, baked=baked_image_id is not None)
+
+# Create EC2 instances from config dict and write changes to output file
+def createEc2Instances(g):
+    config = g['config']
 
-    if image_id:
-        print('creating ec2 instance(s)')
-        while(True):
-            try:
-                reservation = ec2_client.run_instances(
-                    KeyName=config['server']['admin']['ssh_key']['name'],
-                    InstanceType=config['server']['instance_type'],
-                    ImageId=image_id,
-                    MinCount=config['server']['min_count'],
-                    MaxCount=config['server']['max_count'],
-                    UserData=MODIFIED_USERDATA_SCRIPT,
-                    IamInstanceProfile=iam_instance_profile,
-                    BlockDeviceMappings=blockDeviceMappings,
-                    NetworkInterfaces=[
-                        {
-                            "DeviceIndex": 0,
-                            "Groups": [deployed['sg_id']],
-                            'AssociatePublicIpAddress': True,
-                            'SubnetId': subnet_id
-                        }
-                    ]
-                )
-                break
-            except Exception as e:
-                print()
-                print(traceback.format_exception(None, # <- type(e) by docs, but ignored 
-                                     e, e.__traceback__),
-                        file=sys.stderr, flush=True)
-                print()
-                print('See: https://forums.aws.amazon.com/thread.jspa?messageID=593651')
-                print('\"The delay you are seeing for AWS::IAM::InstanceProfile is intended; this is to account for and ensure the IAM service has propagated the profile fully. We do apologize for any inconvenience this may cause.\"')
-                print('Retrying...')
-                print()
-                time.sleep(5)
-
-        instance_ids = []
-        for inst in reservation['Instances']:
-            instance_ids.append(inst['InstanceId'])
-        
-        print('waiting for ec2 instances to be ready/running')
-        # wait for ec2 instances to be ready/running
-        waiter = ec2_client.get_waiter('instance_running')
-        waiter.wait(InstanceIds=instance_ids)
-        
-        print('ec2 instances ready/running')
+    image_id, userdata = getLaunchImageAndUserdata(g)
+
+    instances, instance_count = getRunningInstances(g)
+    max_count = g['config']['server']['max_count']
+    # check that server.max_count is not already exceeded
+    if max_count <= instance_count:
+        print('max_count: ' + str(max_count) + ' for ec2 instances has already been reached ' + '(' + str(instance_count) + ')')
+        updateEC2Deployed(g, instances)
+        print('exiting...')
+        sys.exit(1)
+
+    # serve capacity from the warm pool first (started, not launched), launch the rest
+    wanted = max_count - instance_count
+    pooled_ids = takePooledInstances(g, wanted)
+    instance_ids = []
+    if wanted > len(pooled_ids):
+        min_count = max(1, config['server']['min_count'] - instance_count - len(pooled_ids))
+        instance_ids = launchServers(g, image_id, userdata, min_count, wanted - len(pooled_ids),
+            useLaunchTemplate(g), getPoolTags(g, 'active'))
+
+    # refill the warm pool while the new servers are provisioned
+    if getWarmPoolSize(g) > 0:
+        startBackgroundTask(g, 'refillWarmPool', refillWarmPool)
+    
+    # each instance moves through running -> ssh -> keys -> expire -> yum on its own
+    #  (pooled instances were provisioned before they were stopped)
+    print('provisioning ec2 instances')
+    try:
+        skip = {instance_id: ['keys', 'expire'] for instance_id in pooled_ids}
+        provisionHosts(g, pooled_ids + instance_ids, skip)
+    finally:
         print('updating state data in output file')
         print()
         instances, instance_count = getRunningInstances(g)
         updateEC2Deployed(g, instances)
 
-    else:
-        print('ImageId not found. Check filter values.')
-        exit()
+# Bake an image from the current config: launch one instance with the full userdata,
+#  provision it, create an image of it and terminate it (deploy.py config.yaml bake).
+def bakeImage(g):
+    base_image_id = getImageId(g)
+    bake_hash = getBakeHash(g, base_image_id)
 
-# Get newest AMI filtered on config values
-def getLatestAMI(g):
-    config = g['config']
+    baked_image_id = findBakedImage(g, base_image_id)
+    if baked_image_id:
+        print('image ' + baked_image_id + ' is already baked from this config')
+        return baked_image_id
 
-    images = g['session'].resource('ec2').images.filter(
-        Filters=[
-            {
-                'Name': 'name',
-                'Values': [config['server']['ami_type']+'*']
-            },
-            {
-                'Name': 'architecture',
-                'Values': [config['server']['architecture']]
-            },
-            {
-                'Name': 'virtualization-type',
-                'Values': [config['server']['virtualization_type']]
-            },
-            {
-                'Name': 'root-device-name',
-                'Values': [config['server']['volumes'][0]['device']]
-            },
-            {
-                'Name': 'root-device-type',
-                'Values': [config['server']['root_device_type']]
-            },
-            {
-                'Name': 'owner-alias',
-                'Values': ['amazon']
-            }
-        ]
-    )
-    image_details = sorted(list(images), key=attrgetter('creation_date'), reverse=True)
-    #print(f'Latest AMI: {image_details[0].id}')
-    if image_details[0].id:
-        return image_details[0].id
-    else: return False
\ No newline at end of file
+    userdata = getUserdata(g)
+    instance_ids = launchServers(g, base_image_id, userdata, 1, 1, tags=getPoolTags(g, 'active'))
+
+    ec2_client = g['clients'].client('ec2')
+    try:
+        # no background yum update while the image is taken, and the admin password is
+        #  expired on the instances launched from the image (keys/expire need it usable)
+        print('provisioning bake instance ' + instance_ids[0])
+        provisionHosts(g, instance_ids, skip=['yum', 'expire'])
+        return createBakedImage(g, instance_ids[0], bake_hash)
+    finally:
+        print('terminating bake instance ' + instance_ids[0])
+        ec2_client.terminate_instances(InstanceIds=instance_ids)
+
+# Look up the newest AMI and write its id to output file
+def lookupImage(g):
+    print('getting ami image id')
+    image_id = getLatestAMI(g)
+    if not image_id:
+        raise ValueError('ImageId not found. Check filter values.')
+
+    changes = {}
+    changes['image_id'] = image_id
+    updateDeployed(g, changes)
@@ -0,0 +1,77 @@
+### NOTE: records are built from the describe_instances response only,
+##    so reading an attribute never triggers another api call
+##    (unlike boto3's ec2.Instance resource, which lazy loads).
+
+# every state except terminated
+LIVE_INSTANCE_STATES = ['pending', 'running', 'shutting-down', 'stopping', 'stopped']
+
+# instance tag telling warm pool instances (pooled) from serving ones (active, the default)
+POOL_STATE_TAG = 'pool-state'
+
+
+# compact, read-only view of one ec2 instance
+class InstanceRecord:
+    __slots__ = ('id', 'state', 'subnet_id', 'public_dns_name', 'block_devices', 'tags')
+
+    def __init__(self, instance):
+        self.id = instance['InstanceId']
+        self.state = instance['State']['Name']
+        self.subnet_id = instance.get('SubnetId')
+        self.public_dns_name = instance.get('PublicDnsName', '')
+        # (device name, volume id, attachment status) per attached ebs volume
+        self.block_devices = tuple(
+            (bd['DeviceName'], bd['Ebs']['VolumeId'], bd['Ebs']['Status'])
+            for bd in instance.get('BlockDeviceMappings', []) if 'Ebs' in bd
+        )
+        self.tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+
+    # 'pooled' (warm pool) or 'active'
+    @property
+    def pool_state(self):
+        return self.tags.get(POOL_STATE_TAG, 'active')
+
+    def __repr__(self):
+        return 'InstanceRecord(id=' + self.id + ', state=' + self.state + ')'
+
+
+# instance records with indexes by subnet and by state
+class Inventory:
+    __slots__ = ('records', 'by_subnet', 'by_state')
+
+    def __init__(self, records):
+        self.records = records
+        self.by_subnet = {}
+        self.by_state = {}
+        for record in records:
+            self.by_subnet.setdefault(record.subnet_id, []).append(record)
+            self.by_state.setdefault(record.state, []).append(record)
+
+    # records in any of the given states
+    def inState(self, *states):
+        records = []
+        for state in states:
+            records += self.by_state.get(state, [])
+        return records
+
+    def ids(self):
+        return [record.id for record in self.records]
+
+    def __len__(self):
+        return len(self.records)
+
+# Page through describe_instances once for all instances of vpc_id in states.
+def getInventory(g, vpc_id, states=None):
+    ec2_client = g['clients'].client('ec2')
+    paginator = ec2_client.get_paginator('describe_instances')
+
+    filters = [
+        {"Name": "vpc-id", "Values": [vpc_id]},
+        {"Name": "instance-state-name", "Values": states or LIVE_INSTANCE_STATES},
+    ]
+
+    records = []
+    for page in paginator.paginate(Filters=filters):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                records.append(InstanceRecord(instance))
+    return Inventory(records)
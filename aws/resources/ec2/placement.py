@@ -0,0 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from aws.utils.clients import paginate
+from aws.utils.retry import getErrorCode
+from aws.resources.vpc.vpc import getSubnetsByTag
+
+
+### NOTE: a launch of min_count..max_count instances is split into one shard per
+##    subnet, with the counts spread as evenly as possible, and the shards are
+##    launched concurrently (one run_instances call each).
+##      A shard that hits a capacity error fails over, in order, to subnets in the
+##    other availability zones, then to server.fallback_instance_types (in its own
+##    subnet first). The launch only fails if fewer than min_count instances start.
+
+# errors that mean 'no capacity for this instance type in this az'
+CAPACITY_ERRORS = ['InsufficientInstanceCapacity', 'Unsupported']
+
+# split total into n counts that differ by at most one (larger ones first)
+def spreadCounts(total, n):
+    return [total // n + (1 if i < total % n else 0) for i in range(n)]
+
+# Get [(subnet id, az)] to spread over: every subnet of the vpc (server.placement.subnets: all,
+#  the default) or the ones matching server.subnet.tags (tagged). Tagged subnets come first.
+#  The vpc's subnets are described directly: deployed['subnets'] only holds the tagged
+#  subnets when the vpc already existed.
+def getPlacementSubnets(g):
+    vpc_id = g['deployed']['vpc_id']
+    tagged = getSubnetsByTag(g, vpc_id)
+    tagged_ids = [subnet.id for subnet in tagged]
+
+    if g['config']['server'].get('placement', {}).get('subnets', 'all') == 'tagged':
+        subnets = [(subnet.id, subnet.availability_zone) for subnet in tagged]
+    else:
+        ec2_client = g['clients'].client('ec2')
+        vpc_subnets = paginate(ec2_client, 'describe_subnets', 'Subnets',
+            Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])
+        availability_zones = {subnet['SubnetId']: subnet['AvailabilityZone'] for subnet in vpc_subnets}
+
+        subnet_ids = tagged_ids + sorted(subnet_id for subnet_id in availability_zones if subnet_id not in tagged_ids)
+        subnets = [(subnet_id, availability_zones.get(subnet_id)) for subnet_id in subnet_ids]
+
+    if not subnets:
+        raise ValueError('no subnets to launch into found in vpc ' + vpc_id + ' (check server.subnet.tags and server.placement.subnets)')
+    return subnets
+
+# Get the (subnet id, instance type) a shard tries, in order: its own subnet, subnets in other
+#  azs, then each fallback instance type (own subnet first, then the other azs).
+def getCandidates(g, subnet, subnets):
+    instance_types = [g['config']['server']['instance_type']] + g['config']['server'].get('fallback_instance_types', [])
+    other_azs = []
+    for other in subnets:
+        if other[1] != subnet[1] and other[1] not in [az for _, az in other_azs]:
+            other_azs.append(other)
+
+    candidates = []
+    for instance_type in instance_types:
+        for subnet_id, _ in [subnet] + other_azs:
+            candidates.append((subnet_id, instance_type))
+    return candidates
+
+# Launch one shard, failing over on capacity errors. Returns the launched instance ids.
+def launchShard(g, launch, request, network_interface, min_count, max_count, candidates):
+    default_type = g['config']['server']['instance_type']
+    for i, (subnet_id, instance_type) in enumerate(candidates):
+        shard_request = dict(request)
+        if instance_type != default_type:
+            shard_request['InstanceType'] = instance_type
+        try:
+            reservation = launch(g,
+                MinCount=min_count,
+                MaxCount=max_count,
+                NetworkInterfaces=[dict(network_interface, SubnetId=subnet_id)],
+                **shard_request
+            )
+        except Exception as e:
+            if getErrorCode(e) not in CAPACITY_ERRORS or i == len(candidates) - 1:
+                raise
+            print('  no capacity for ' + instance_type + ' in ' + subnet_id + ' (' + getErrorCode(e) + '), trying ' + candidates[i + 1][1] + ' in ' + candidates[i + 1][0])
+            continue
+        print('  launched ' + str(len(reservation['Instances'])) + ' ' + instance_type + ' instance(s) in ' + subnet_id)
+        return [inst['InstanceId'] for inst in reservation['Instances']]
+
+# Spread min_count..max_count instances over the placement subnets and launch the shards
+#  concurrently with launch(g, **run_instances args). request holds every run_instances
+#  argument except the counts and the network interfaces. Returns the instance ids.
+def placeInstances(g, launch, request, network_interface, min_count, max_count):
+    subnets = getPlacementSubnets(g)
+    # no more shards than instances
+    shard_subnets = subnets[:max(1, min(len(subnets), max_count))]
+
+    shards = []
+    for subnet, shard_min, shard_max in zip(shard_subnets, spreadCounts(min_count, len(shard_subnets)), spreadCounts(max_count, len(shard_subnets))):
+        if shard_max > 0:
+            shards.append((subnet, max(1, shard_min), shard_max))
+
+    instance_ids = []
+    error = None
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        futures = [
+            executor.submit(launchShard, g, launch, request, network_interface, shard_min, shard_max, getCandidates(g, subnet, subnets))
+            for subnet, shard_min, shard_max in shards
+        ]
+        for future in futures:
+            try:
+                instance_ids += future.result()
+            except Exception as e:
+                print('  launch in a subnet failed: ' + str(e))
+                error = error or e
+
+    if error is not None and len(instance_ids) < min_count:
+        raise error
+    return instance_ids
@@ -0,0 +1,111 @@
+from botocore.exceptions import ClientError
+
+from aws.utils.utils import updateDeployed
+from aws.utils.retry import getErrorCode, getErrorMessage
+from aws.resources.ec2.inventory import getInventory, POOL_STATE_TAG
+from aws.resources.ec2.provision import provisionHosts
+from aws.resources.ec2.template import useLaunchTemplate
+from aws.resources.ec2.userdata.render import getUserdataPlan, getPlanHash
+
+
+### NOTE: the warm pool (server.warm_pool.size) is a set of fully provisioned,
+##    stopped instances in the deployment vpc, tagged pool-state=pooled.
+##    createEc2Instances starts pooled instances first (retagged active) and
+##    launches only what is still missing, then the pool is refilled on a
+##    background thread. Pooled instances are also tagged with the hash of the
+##    userdata they were provisioned with; instances from an older config are
+##    never started and are terminated on refill.
+
+# instance tag holding the userdata plan hash a pooled instance was provisioned with
+POOL_HASH_TAG = 'pool-config-hash'
+
+# number of stopped instances kept in the warm pool (0 disables it)
+def getWarmPoolSize(g):
+    return g['config']['server'].get('warm_pool', {}).get('size', 0)
+
+# hash of the userdata (full plan) pooled instances are provisioned with
+def getPoolHash(g):
+    return getPlanHash(getUserdataPlan(g))
+
+# instance tags for pool_state ('pooled' or 'active')
+def getPoolTags(g, pool_state):
+    return [
+        {'Key': POOL_STATE_TAG, 'Value': pool_state},
+        {'Key': POOL_HASH_TAG, 'Value': getPoolHash(g)}
+    ]
+
+# get the warm pool instance records (any live state) in the deployment vpc
+def getPooledInstances(g):
+    inventory = getInventory(g, g['deployed']['vpc_id'])
+    return [record for record in inventory.records if record.pool_state == 'pooled']
+
+# Take up to count stopped pool instances of the current config: start them and
+#  retag them active. Returns their ids ([] if they could not be started) (provisioning still has to wait for them, see provision.py).
+def takePooledInstances(g, count):
+    if count <= 0 or getWarmPoolSize(g) <= 0:
+        return []
+
+    pool_hash = getPoolHash(g)
+    ready = [
+        record.id for record in getPooledInstances(g)
+        if record.state == 'stopped' and record.tags.get(POOL_HASH_TAG) == pool_hash
+    ][:count]
+    if not ready:
+        return []
+
+    ec2_client = g['clients'].client('ec2')
+    # retag only once they started, so instances that failed to start (eg. no capacity) stay pooled
+    try:
+        ec2_client.start_instances(InstanceIds=ready)
+    except ClientError as e:
+        # the missing capacity is launched instead
+        print('  starting warm pool instance(s) failed (' + str(getErrorCode(e)) + '): ' + getErrorMessage(e))
+        return []
+    ec2_client.create_tags(Resources=ready, Tags=[{'Key': POOL_STATE_TAG, 'Value': 'active'}])
+    print('started ' + str(len(ready)) + ' instance(s) from the warm pool: ' + ', '.join(ready))
+    return ready
+
+# Bring the warm pool back to its size: terminate pooled instances of an older config,
+#  launch and provision the missing ones, stop them, and write the pool to output file.
+def refillWarmPool(g):
+    # ec2.py imports this module
+    from aws.resources.ec2.ec2 import launchServers, getLaunchImageAndUserdata
+
+    ec2_client = g['clients'].client('ec2')
+    size = getWarmPoolSize(g)
+    pool_hash = getPoolHash(g)
+
+    pooled = []
+    stale = []
+    for record in getPooledInstances(g):
+        if record.tags.get(POOL_HASH_TAG) == pool_hash:
+            pooled.append(record.id)
+        else:
+            stale.append(record.id)
+
+    if stale:
+        print('terminating ' + str(len(stale)) + ' warm pool instance(s) of an older config')
+        ec2_client.terminate_instances(InstanceIds=stale)
+
+    missing = size - len(pooled)
+    if missing > 0:
+        print('refilling warm pool with ' + str(missing) + ' instance(s)')
+        image_id, userdata = getLaunchImageAndUserdata(g)
+        instance_ids = launchServers(g, image_id, userdata, missing, missing,
+            useLaunchTemplate(g), getPoolTags(g, 'pooled'))
+        try:
+            provisionHosts(g, instance_ids, skip=['yum'])
+        except Exception:
+            # never pool an instance that is not fully provisioned
+            ec2_client.terminate_instances(InstanceIds=instance_ids)
+            raise
+        ec2_client.stop_instances(InstanceIds=instance_ids)
+        ec2_client.get_waiter('instance_stopped').wait(
+            InstanceIds=instance_ids,
+            WaiterConfig={'Delay': 5, 'MaxAttempts': 120}
+        )
+        pooled += instance_ids
+
+    changes = {}
+    changes['warm_pool'] = pooled
+    updateDeployed(g, changes)
@@ -0,0 +1,112 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aws.utils.ssh import sendUserKeys, expire_admin_password, start_yum_update
+from aws.resources.ec2.readiness import waitForSshd, waitForLogin, waitForUserdata
+
+
+### NOTE: every host goes through the stages below on its own worker, so a host
+##    moves on as soon as it is ready instead of waiting for the slowest host
+##    at every stage. The run ends with a table of when each host finished
+##    each stage (seconds since provisioning started).
+##
+##      running -> sshd up -> admin login -> userdata finished (usable)
+##        -> keys sent -> admin password expired -> yum update kicked
+
+# wait until the instance is running and return its public dns name
+def waitForRunning(g, instance_id):
+    ec2_client = g['clients'].client('ec2')
+    ec2_client.get_waiter('instance_running').wait(
+        InstanceIds=[instance_id],
+        WaiterConfig={'Delay': 2, 'MaxAttempts': 150}
+    )
+    reservations = ec2_client.describe_instances(InstanceIds=[instance_id])['Reservations']
+    return reservations[0]['Instances'][0]['PublicDnsName']
+
+# the stages, in order: (name, fn(g, hostname))
+PROVISIONING_STAGES = [
+    ('sshd', waitForSshd),
+    ('login', waitForLogin),
+    ('ready', waitForUserdata),
+    ('keys', sendUserKeys),
+    ('expire', expire_admin_password),
+    ('yum', start_yum_update),
+]
+
+# Get the stages for this config, without the ones named in skip.
+#  Keys embedded in userdata don't need to be sent.
+def getProvisioningStages(g, skip=()):
+    skip = set(skip)
+    if g['config']['server'].get('userdata', {}).get('embed_public_keys', False):
+        skip.add('keys')
+    return [(stage_name, stage) for stage_name, stage in PROVISIONING_STAGES if stage_name not in skip]
+
+# run every stage for one instance, recording the time each stage finished
+def provisionHost(g, instance_id, started, timings, skip=()):
+    timings[instance_id] = {}
+
+    hostname = waitForRunning(g, instance_id)
+    timings[instance_id]['running'] = time.time() - started
+
+    for stage_name, stage in getProvisioningStages(g, skip):
+        stage(g, hostname)
+        timings[instance_id][stage_name] = time.time() - started
+    return hostname
+
+# get the stages skipped for instance_id (skip is a list for every instance, or {instance_id: list})
+def getSkippedStages(skip, instance_id):
+    if isinstance(skip, dict):
+        return skip.get(instance_id, ())
+    return skip
+
+# print per host stage timings (a stage skipped on every host gets no column)
+def printTimingTable(g, instance_ids, timings, skip=()):
+    run_stages = set()
+    for instance_id in instance_ids:
+        run_stages.update(stage_name for stage_name, _ in getProvisioningStages(g, getSkippedStages(skip, instance_id)))
+    columns = ['running'] + [stage_name for stage_name, _ in PROVISIONING_STAGES if stage_name in run_stages]
+
+    print()
+    print('instance'.ljust(22) + ''.join(column.rjust(10) for column in columns))
+    for instance_id in instance_ids:
+        row = instance_id.ljust(22)
+        for column in columns:
+            if column in timings.get(instance_id, {}):
+                row += '{:.1f}s'.format(timings[instance_id][column]).rjust(10)
+            else:
+                row += '-'.rjust(10)
+        print(row)
+    print()
+
+    # time to usable: from provisioning start until userdata finished
+    ready = sorted(timings[instance_id]['ready'] for instance_id in instance_ids if 'ready' in timings.get(instance_id, {}))
+    if ready:
+        print('time to usable: min ' + '{:.1f}s'.format(ready[0]) + ', median ' + '{:.1f}s'.format(ready[len(ready) // 2]) + ', max ' + '{:.1f}s'.format(ready[-1]) + ' (' + str(len(ready)) + '/' + str(len(instance_ids)) + ' hosts)')
+        print()
+
+# Provision every instance through the stage pipeline on a bounded worker pool.
+#  Hosts that fail don't stop the others; the first error is raised once all are done.
+#  skip: names of stages not to run (eg. 'yum' on an instance that is about to be imaged),
+#  for every instance or per instance as {instance_id: names}
+def provisionHosts(g, instance_ids, skip=()):
+    max_workers = g['config']['server'].get('provisioning', {}).get('max_workers', 10)
+    started = time.time()
+    timings = {}
+    error = None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(provisionHost, g, instance_id, started, timings, getSkippedStages(skip, instance_id)): instance_id
+            for instance_id in instance_ids
+        }
+        for future, instance_id in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print('  provisioning ' + instance_id + ' failed: ' + str(e))
+                error = error or e
+
+    printTimingTable(g, instance_ids, timings, skip)
+
+    if error is not None:
+        raise error
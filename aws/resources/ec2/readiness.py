@@ -0,0 +1,93 @@
+import socket, time
+
+import paramiko
+
+from aws.utils.retry import retryWithBackoff
+from aws.utils.sshpool import getSSHPool
+from aws.utils.remote import runOnHost
+from aws.resources.ec2.userdata.userdata import USERDATA_FINISHED_PATH
+
+
+### NOTE: a new host is usable once all three checks below pass, in order.
+##    Each check is retried with short exponential backoff, so a host moves on
+##    as soon as it is ready instead of after a fixed sleep.
+##
+##      sshd:  tcp/22 accepts connections and answers with an ssh banner
+##      login: admin can log in (userdata creates the admin user, so early
+##             auth failures are expected for a short grace period)
+##      ready: userdata (cloud-init) has finished and written its sentinel file
+
+SSH_PORT = 22
+
+# the host is not ready yet (retried)
+class NotReady(Exception):
+    pass
+
+# the host answers, but rejects the admin key (not retried)
+class AuthFailed(Exception):
+    pass
+
+# userdata failed on the host (not retried)
+class UserdataFailed(Exception):
+    pass
+
+# tell errors that mean 'not ready yet' apart from real failures
+def isNotReady(e):
+    if isinstance(e, (AuthFailed, UserdataFailed, FileNotFoundError, PermissionError)):
+        return False
+    return isinstance(e, (NotReady, OSError, EOFError, paramiko.SSHException))
+
+def getProvisioningConfig(g):
+    return g['config']['server'].get('provisioning', {})
+
+# wait until sshd on hostname accepts a connection and sends its banner
+def waitForSshd(g, hostname):
+    connect_timeout = g['config'].get('ssh', {}).get('connect_timeout', 10)
+
+    def probe():
+        with socket.create_connection((hostname, SSH_PORT), timeout=connect_timeout) as sock:
+            banner = sock.recv(256)
+        if not banner.startswith(b'SSH-'):
+            raise NotReady('no ssh banner yet')
+
+    timeout = getProvisioningConfig(g).get('ssh_timeout', 300)
+    retryWithBackoff(probe, isNotReady, 'sshd ' + hostname, base=0.25, cap=2, deadline_seconds=timeout)
+
+# Wait until admin can log in (the connection is kept in the ssh pool). Auth failures
+#  count as 'not ready' for auth_grace_seconds, after that they are raised as AuthFailed.
+def waitForLogin(g, hostname):
+    provisioning = getProvisioningConfig(g)
+    grace = provisioning.get('auth_grace_seconds', 120)
+    started = time.time()
+
+    def connect():
+        try:
+            getSSHPool(g).get(hostname)
+        except paramiko.AuthenticationException as e:
+            getSSHPool(g).discard(hostname)
+            if time.time() - started > grace:
+                raise AuthFailed('admin login to ' + hostname + ' rejected, check server.admin.ssh_key (' + str(e) + ')')
+            raise NotReady('admin user not created yet')
+        except Exception:
+            getSSHPool(g).discard(hostname)
+            raise
+
+    timeout = provisioning.get('ssh_timeout', 300)
+    retryWithBackoff(connect, isNotReady, 'ssh login ' + hostname, base=0.5, cap=5, deadline_seconds=timeout)
+
+# poll for the sentinel file, exiting 1 as soon as cloud-init reports an error
+USERDATA_WAIT_SCRIPT = (
+    'until [ -f ' + USERDATA_FINISHED_PATH + ' ]; do '
+    'if cloud-init status 2>/dev/null | grep -q "status: error"; then exit 1; fi; '
+    'sleep 1; '
+    'done'
+)
+
+# wait until userdata has finished on hostname
+def waitForUserdata(g, hostname):
+    timeout = getProvisioningConfig(g).get('userdata_timeout', 600)
+    status = runOnHost(g, hostname, USERDATA_WAIT_SCRIPT, timeout=timeout)
+    if status == 1:
+        raise UserdataFailed('userdata failed on ' + hostname + ' (see /var/log/cloud-init-output.log)')
+    elif status != 0:
+        raise NotReady('userdata on ' + hostname + ' did not finish within ' + str(timeout) + 's')
@@ -0,0 +1,115 @@
+import json, base64, hashlib
+
+from botocore.exceptions import ClientError
+
+from aws.utils.utils import updateDeployed
+from aws.utils.clients import paginate
+from aws.utils.retry import getErrorCode
+from aws.resources.vpc.vpc import getTagsFromConfig
+
+
+### NOTE: with server.launch.use_template, the server config (ami, instance type,
+##    key, userdata, volumes, instance profile) is stored once as a launch template
+##    version, and run_instances only references the template id and version
+##    (plus the network interface, which picks the subnet).
+##      Each version's description holds the hash of its data, so a version is
+##    only created when that hash changes; unchanged configs re-use the existing one.
+
+# prefix of the version description, followed by the hash of the template data
+VERSION_DESCRIPTION_PREFIX = 'config-hash:'
+
+# check whether launch template mode is on
+def useLaunchTemplate(g):
+    return g['config']['server'].get('launch', {}).get('use_template', False)
+
+# get the launch template name (server.launch.template_name, default: <vpc Name tag>-server)
+def getLaunchTemplateName(g):
+    launch = g['config']['server'].get('launch', {})
+    if 'template_name' in launch:
+        return launch['template_name']
+    return g['config']['vpc']['tags'][0]['value'] + '-server'
+
+# build the launch template data (userdata is bytes, the template stores it base64 encoded)
+def getLaunchTemplateData(g, image_id, userdata, instance_profile, block_device_mappings):
+    config = g['config']
+    return {
+        'ImageId': image_id,
+        'InstanceType': config['server']['instance_type'],
+        'KeyName': config['server']['admin']['ssh_key']['name'],
+        'UserData': base64.b64encode(userdata).decode(),
+        'IamInstanceProfile': instance_profile,
+        'BlockDeviceMappings': block_device_mappings
+    }
+
+# hash of the template data
+def getLaunchTemplateHash(template_data):
+    return hashlib.sha256(json.dumps(template_data, sort_keys=True).encode()).hexdigest()
+
+# get the launch template (None if there is none with this name)
+def getLaunchTemplate(g, name):
+    ec2_client = g['clients'].client('ec2')
+    try:
+        templates = ec2_client.describe_launch_templates(LaunchTemplateNames=[name])['LaunchTemplates']
+    except ClientError as e:
+        if getErrorCode(e) == 'InvalidLaunchTemplateName.NotFoundException':
+            return None
+        raise
+    return templates[0] if templates else None
+
+# find the version of template_id created for template_hash (None if there is none)
+def findLaunchTemplateVersion(g, template_id, template_hash):
+    ec2_client = g['clients'].client('ec2')
+    for version in paginate(ec2_client, 'describe_launch_template_versions', 'LaunchTemplateVersions', LaunchTemplateId=template_id):
+        if version.get('VersionDescription') == VERSION_DESCRIPTION_PREFIX + template_hash:
+            return version['VersionNumber']
+    return None
+
+# Get (template id, version) for template_data, creating the template or a new
+#  version only when no version with the same hash exists. Writes it to output file.
+def ensureLaunchTemplate(g, template_data):
+    ec2_client = g['clients'].client('ec2')
+    name = getLaunchTemplateName(g)
+    template_hash = getLaunchTemplateHash(template_data)
+    description = VERSION_DESCRIPTION_PREFIX + template_hash
+
+    template = getLaunchTemplate(g, name)
+    if template is None:
+        print('creating launch template ' + name)
+        template = ec2_client.create_launch_template(
+            LaunchTemplateName=name,
+            VersionDescription=description,
+            LaunchTemplateData=template_data,
+            TagSpecifications=[{'ResourceType': 'launch-template', 'Tags': getTagsFromConfig(g['config']['vpc']['tags'])}]
+        )['LaunchTemplate']
+        template_id = template['LaunchTemplateId']
+        version = template['LatestVersionNumber']
+    else:
+        template_id = template['LaunchTemplateId']
+        version = findLaunchTemplateVersion(g, template_id, template_hash)
+        if version is None:
+            print('creating launch template version for ' + name)
+            version = ec2_client.create_launch_template_version(
+                LaunchTemplateId=template_id,
+                VersionDescription=description,
+                LaunchTemplateData=template_data
+            )['LaunchTemplateVersion']['VersionNumber']
+        else:
+            print('re-using launch template ' + name + ' version ' + str(version))
+
+    changes = {}
+    changes['launch_template'] = {'id': template_id, 'name': name, 'version': version}
+    updateDeployed(g, changes)
+    return template_id, version
+
+# delete the launch template (and all its versions)
+def deleteLaunchTemplate(g):
+    name = getLaunchTemplateName(g)
+    template = getLaunchTemplate(g, name)
+    if template is None:
+        return
+    print('deleting launch template ' + name)
+    try:
+        g['clients'].client('ec2').delete_launch_template(LaunchTemplateId=template['LaunchTemplateId'])
+    except ClientError as e:
+        if getErrorCode(e) != 'InvalidLaunchTemplateId.NotFound':
+            raise
@@ -0,0 +1,158 @@
+import os, json, gzip, shlex, hashlib
+
+from aws.utils.state import atomicWrite
+from aws.utils.utils import getCachePath
+from aws.utils.ssh import getAuthorizedKeyLine, getPublicKeyPath
+from aws.resources.ec2.userdata.userdata import USERDATA_SCRIPT_TEMPLATE, USERDATA_FINISHED_PATH, getUserdataFromTemplate
+
+
+### NOTE: userdata is built in two steps:
+##      getUserdataPlan:   config.yaml (+ public keys) -> plan (plain dict, what to do)
+##      renderUserdata:    plan -> script (one pass, every value shell quoted)
+##    The final (possibly compressed) blob is cached under the hash of the plan
+##    and the template, so an unchanged config re-uses it without rendering.
+
+# ec2 limit for userdata, in bytes before base64 encoding
+USERDATA_LIMIT_BYTES = 16384
+
+# bump when renderUserdata output changes for the same plan
+RENDERER_VERSION = 2
+
+# Build the userdata plan from config.yaml. baked: the instance is launched from an
+#  image baked with the full userdata (see aws/resources/ec2/bake.py).
+def getUserdataPlan(g, baked=False):
+    config = g['config']
+    server = config['server']
+    userdata_config = server.get('userdata', {})
+    embed_public_keys = userdata_config.get('embed_public_keys', False)
+
+    users = []
+    for user in server['users']:
+        users.append({
+            'login': user['login'],
+            'sudo': bool(user['can_sudo']),
+            'key': getAuthorizedKeyLine(getPublicKeyPath(g, user), user['login']) if embed_public_keys else None
+        })
+
+    users_mode = userdata_config.get('users', 'per_user')
+    return {
+        'baked': baked,
+        'password': server['admin']['initial_sudo_password'],
+        'parallel': userdata_config.get('mode', 'parallel') == 'parallel',
+        'install_aws_cli': userdata_config.get('install_aws_cli', False),
+        'volumes': [
+            {'device': volume['device'], 'type': volume['type'], 'mount': volume['mount']}
+            for volume in server['volumes'] if volume['mount'] != '/'
+        ],
+        'admin': server['admin']['login'],
+        'users': users,
+        'bulk_users': users_mode == 'bulk',
+        # bulk mode ships the userdata gzip compressed (cloud-init decompresses it)
+        'compress': userdata_config.get('compress', users_mode == 'bulk')
+    }
+
+# build one shell command line, quoting every argument
+def shellCommand(*args, background=False):
+    return ' '.join(shlex.quote(str(arg)) for arg in args) + (' &' if background else '')
+
+# userdata for an instance launched from a baked image: users, shared directories and
+#  /etc/fstab are already in the image, only per instance work is left
+BAKED_USERDATA_SCRIPT = '''#!/bin/bash
+set -x
+set -e
+
+# cloud-init creates ec2-user again on every new instance
+if id ec2-user > /dev/null 2>&1; then
+    userdel -r ec2-user
+fi
+
+# mount the volumes listed in /etc/fstab (formatted when the image was baked)
+mount -a
+'''
+
+# render the userdata script for plan
+def renderUserdata(plan):
+    if plan['baked']:
+        return BAKED_USERDATA_SCRIPT + shellCommand('touch', USERDATA_FINISHED_PATH) + '\n'
+
+    background = plan['parallel']
+    mounts = [volume['mount'] for volume in plan['volumes']]
+    lines = []
+
+    # optional installs are opt-in
+    if plan['install_aws_cli']:
+        lines.append(shellCommand('installAwsCli', background=background))
+
+    # format and mount volumes (concurrently in parallel mode, while users are created)
+    for volume in plan['volumes']:
+        lines.append(shellCommand('formatAndMount', volume['device'], volume['type'], volume['mount'], background=background))
+
+    lines.append(shellCommand('createAdminUser', plan['admin']))
+
+    if plan['bulk_users']:
+        # one manifest line per user: <login> <can_sudo> [authorized_keys line]
+        lines.append("writeUserManifest <<'MANIFEST'")
+        for user in plan['users']:
+            lines.append(' '.join([user['login'], '1' if user['sudo'] else '0'] + ([user['key']] if user['key'] else [])))
+        lines.append('MANIFEST')
+        lines.append(shellCommand('createUsersFromManifest'))
+    else:
+        for user in plan['users']:
+            if user['key']:
+                lines.append(shellCommand('createRegularUser', user['login'], user['key']))
+            else:
+                lines.append(shellCommand('createRegularUser', user['login']))
+
+    # volumes have to be mounted before the shared directories are made
+    lines.append(shellCommand('waitAll'))
+
+    if plan['bulk_users']:
+        if mounts:
+            lines.append(shellCommand('makeSharedDirectoriesFromManifest', *mounts))
+    else:
+        for user in plan['users']:
+            for mount in mounts:
+                lines.append(shellCommand('makeSharedDirectory', user['login'], mount, background=background))
+        for user in plan['users']:
+            if user['sudo']:
+                lines.append(shellCommand('giveUserSudo', user['login'], background=background))
+
+    # mark userdata as finished once the background jobs are done
+    lines.append(shellCommand('waitAll'))
+    lines.append(shellCommand('touch', USERDATA_FINISHED_PATH))
+
+    # the shebang has to be the first line for cloud-init to run the script
+    return getUserdataFromTemplate(plan['password']).lstrip() + '\n' + '\n'.join(lines) + '\n'
+
+# hash of everything the rendered blob depends on
+def getPlanHash(plan):
+    content = json.dumps(plan, sort_keys=True) + str(RENDERER_VERSION) + USERDATA_SCRIPT_TEMPLATE + BAKED_USERDATA_SCRIPT
+    return hashlib.sha256(content.encode()).hexdigest()
+
+# get path of the cached blob for plan_hash (under cache.directory in config.yaml)
+def getUserdataCachePath(g, plan_hash):
+    return getCachePath(g, plan_hash, 'userdata')
+
+# Get the userdata blob (bytes) for this config: cached, or rendered (and compressed).
+#  Raises ValueError when it is larger than the ec2 limit, before any launch call is made.
+def getUserdata(g, baked=False):
+    plan = getUserdataPlan(g, baked)
+    path = getUserdataCachePath(g, getPlanHash(plan))
+
+    if os.path.exists(path):
+        with open(path, 'rb') as handle:
+            userdata = handle.read()
+        source = 'cached'
+    else:
+        userdata = renderUserdata(plan).encode()
+        if plan['compress']:
+            userdata = gzip.compress(userdata)
+        atomicWrite(path, userdata)
+        source = 'rendered'
+
+    print('userdata: ' + str(len(userdata)) + ' of ' + str(USERDATA_LIMIT_BYTES) + ' bytes'
+        + (' (gzip)' if plan['compress'] else '') + ', ' + source)
+    if len(userdata) > USERDATA_LIMIT_BYTES:
+        raise ValueError('userdata is ' + str(len(userdata)) + ' bytes, over the ec2 limit of ' + str(USERDATA_LIMIT_BYTES)
+            + ' (set server.userdata.users: bulk to compress it)')
+    return userdata
@@ -1,3 +1,4 @@
+import shlex
 from string import Template
 
 # dollar signs have to be escaped by adding an additional '$' before them.
@@ -7,14 +8,30 @@ USERDATA_SCRIPT_TEMPLATE = '''
 set -x #mode of the shell where all executed commands are printed to the terminal.
 set -e #mode of the shell that immediately exits if any command (1) has a non-zero exit status.
 
+# temporary sudo password (initial_sudo_password from config, shell quoted)
+INITIAL_PASSWORD=$password
+
 EC2_INSTANCE_ID=$$(curl -s http://instance-data/latest/meta-data/instance-id)
 REGION=$$(curl -s http://instance-data/latest/meta-data/placement/region)
 
-#install aws cli (2)
-yum install -y unzip
-curl "https://awscli.amazonaws.com/awscli-exe-linux-x86_64.zip" -o "awscliv2.zip"
-unzip awscliv2.zip
-./aws/install
+### installAwsCli()
+##  NOTE: only called when server.userdata.install_aws_cli is true
+##    (nothing in this script needs it).
+installAwsCli () {
+    yum install -y unzip
+    curl "https://awscli.amazonaws.com/awscli-exe-linux-x86_64.zip" -o "awscliv2.zip"
+    unzip awscliv2.zip
+    ./aws/install
+}
+
+### waitAll()
+##  NOTE: waits for every background job one by one, so (with set -e)
+##    the script stops if any of them failed.
+waitAll () {
+    for pid in $$(jobs -p); do
+        wait $$pid
+    done
+}
 
 ### giveUserSudo(username)
 ##  NOTE: 
@@ -29,7 +46,7 @@ giveUserSudo () {
     usermod -aG wheel $$1
 
     # set new users password to initial_sudo_password from config
-    echo $$1:"$password" | chpasswd
+    echo "$$1:$${INITIAL_PASSWORD}" | chpasswd
 
     # expire password for user (require change on next login)
     passwd --expire $$1
@@ -65,19 +82,21 @@ createAdminUser () {
     chown $$1:$$1 -R /home/$$1/.ssh
 
     # set new admin users sudo password to initial_sudo_password from config
-    echo $$1:"$password" | chpasswd
+    echo "$$1:$${INITIAL_PASSWORD}" | chpasswd
 
     # delete ec2-user (and home directory)
     userdel -r ec2-user
 }
 
 
-### createUser(username)
+### createUser(username, [public_key])
 ##  NOTE:
-##      This function does not create/handle ssh keys for new users. 
-##    It does create an initial empty authorized_keys file.
+##      This function only writes an ssh key for the new user when one is
+##    passed in (server.userdata.embed_public_keys). Otherwise it creates an
+##    initial empty authorized_keys file and keys are sent over ssh later.
 #
 # $$1 ==> username
+# $$2 ==> authorized_keys line (optional)
 createRegularUser () {
 
     # add new user with -s and -m options
@@ -89,6 +108,9 @@ createRegularUser () {
 
     # create new user's .ssh/authorized_keys file with appropriate permissions
     touch /home/$$1/.ssh/authorized_keys
+    if [ -n "$${2:-}" ]; then
+        echo "$$2" > /home/$$1/.ssh/authorized_keys
+    fi
     chmod 600 /home/$$1/.ssh/authorized_keys
 
     # change (recursive) ownership from root:root to new user for .ssh/
@@ -96,6 +118,71 @@ createRegularUser () {
 }
 
 
+### User manifest (server.userdata.users: bulk)
+##  NOTE:
+##      Instead of one createRegularUser/makeSharedDirectory/giveUserSudo call
+##    per user, every user is listed once in a manifest file, one line each:
+##
+##      <login> <can_sudo (0 or 1)> [authorized_keys line]
+##
+##    and the functions below apply it with a fixed number of commands
+##    (newusers/chpasswd/gpasswd take every user at once), so boot time
+##    doesn't grow with one useradd (which rewrites /etc/passwd) per user.
+USER_MANIFEST=/var/lib/cloud/instance/users.manifest
+
+### writeUserManifest()
+##  NOTE: reads the manifest from stdin (a here-document).
+writeUserManifest () {
+    cat > $${USER_MANIFEST}
+    chmod 600 $${USER_MANIFEST}
+}
+
+### createUsersFromManifest()
+createUsersFromManifest () {
+
+    # create every user, group and home directory with one newusers call,
+    # then lock the (throwaway) passwords like useradd leaves them
+    awk '{ print $$1 ":locked:::" ":/home/" $$1 ":/bin/bash" }' $${USER_MANIFEST} | newusers
+    awk '{ print $$1 ":!!" }' $${USER_MANIFEST} | chpasswd -e
+
+    # create .ssh directories and authorized_keys files (the key is empty unless embedded)
+    awk '{ print "/home/" $$1 "/.ssh" }' $${USER_MANIFEST} | xargs mkdir -p
+    awk '{ print "/home/" $$1 "/.ssh" }' $${USER_MANIFEST} | xargs chmod 700
+    awk '{
+        key = ""
+        for (i = 3; i <= NF; i++) key = key (i > 3 ? " " : "") $$i
+        file = "/home/" $$1 "/.ssh/authorized_keys"
+        printf "%s", (key == "" ? "" : key "\\n") > file
+        close(file)
+    }' $${USER_MANIFEST}
+    awk '{ print "/home/" $$1 "/.ssh/authorized_keys" }' $${USER_MANIFEST} | xargs chmod 600
+
+    # change (recursive) ownership from root:root to each user for .ssh/
+    awk '{ print $$1 ":" $$1 " /home/" $$1 "/.ssh" }' $${USER_MANIFEST} | xargs -n 2 chown -R
+
+    # sudo users: add all of them to the wheel group at once, set the
+    # temporary sudo password and expire it (require change on next login)
+    SUDO_USERS=$$(awk '$$2 == 1 { print $$1 }' $${USER_MANIFEST})
+    if [ -n "$${SUDO_USERS}" ]; then
+        WHEEL_MEMBERS=$$( (getent group wheel | cut -d: -f4 | tr ',' '\\n'; echo "$${SUDO_USERS}") | grep -v '^$$' | sort -u | paste -sd, -)
+        gpasswd -M "$${WHEEL_MEMBERS}" wheel
+        echo "$${SUDO_USERS}" | INITIAL_PASSWORD="$${INITIAL_PASSWORD}" awk '{ print $$1 ":" ENVIRON["INITIAL_PASSWORD"] }' | chpasswd
+        echo "$${SUDO_USERS}" | xargs -n 1 passwd --expire
+    fi
+}
+
+### makeSharedDirectoriesFromManifest(directory ...)
+##  NOTE: same as makeSharedDirectory, for every user in the manifest
+##    and every directory passed in (the mounted volumes).
+makeSharedDirectoriesFromManifest () {
+    for directory in "$$@"; do
+        awk -v d="$${directory}" '{ print d "/" $$1 }' $${USER_MANIFEST} | xargs mkdir -p
+        awk -v d="$${directory}" '{ print "root:" $$1 " " d "/" $$1 }' $${USER_MANIFEST} | xargs -n 2 chown -R
+        awk -v d="$${directory}" '{ print d "/" $$1 }' $${USER_MANIFEST} | xargs chmod -R g+w
+    done
+}
+
+
 ### makeSharedDirectory(username, directory)
 ##      This function creates a user owned directory
 ##    (of the same name) within a specific parent directory.
@@ -127,6 +214,7 @@ makeSharedDirectory () {
 ### formatAndMount(device_name, device_type, mount_path)
 ##       This function checks that the device is attached,
 ##    then creates formatted partition and mounts it.
+##    In parallel mode every volume is formatted at the same time.
 ##    Lastly, an entry is appended to /etc/fstab to 
 ##   mount volume on reboot.
 #
@@ -149,9 +237,17 @@ formatAndMount () {
     #    sleep 5
     #done
 
-    # Format $$1 if it does not contain a partition yet
+    # Format $$1 if it does not contain a partition yet.
+    #  ext4 inode tables/journal are initialized lazily (in the background after mount)
+    #  and xfs skips discarding blocks, which a new ebs volume doesn't need.
     if [ "$$(file -b -s $$1)" == "data" ]; then
-        mkfs -t $$2 $$1
+        if [ "$$2" == "ext4" ]; then
+            mkfs -t $$2 -E lazy_itable_init=1,lazy_journal_init=1 $$1
+        elif [ "$$2" == "xfs" ]; then
+            mkfs -t $$2 -K $$1
+        else
+            mkfs -t $$2 $$1
+        fi
     fi
 
     mkdir -p $$3
@@ -164,6 +260,9 @@ formatAndMount () {
 '''
 TEMPLATED_USERDATA_SCRIPT = Template(USERDATA_SCRIPT_TEMPLATE)
 
+# written as the last step of userdata (polled by aws/resources/ec2/readiness.py)
+USERDATA_FINISHED_PATH = '/var/lib/cloud/instance/userdata-finished'
+
 # apply template and return userdata shell script as string
 def getUserdataFromTemplate(temporary_password):
-    return TEMPLATED_USERDATA_SCRIPT.substitute(password = temporary_password)
\ No newline at end of file
+    return TEMPLATED_USERDATA_SCRIPT.substitute(password = shlex.quote(temporary_password))
\ No newline at end of file
@@ -1,76 +1,108 @@
-import os, json
+import os, json, threading
 from pprint import pprint
 
-from aws.utils.utils import readFromFile
+from botocore.exceptions import ClientError
 
+from aws.utils.utils import readFromFile, updateDeployed
+
+
+### NOTE: the snapshot holds everything already looked up during this run,
+##    by kind ('roles', 'policies', 'profiles') and name. A name mapped to None
+##    is known not to exist. Create/delete/attach calls keep it up to date.
+SNAPSHOT_LOCK = threading.Lock()
+
+# get (or create) this run's iam snapshot
+def getIamSnapshot(g):
+    with SNAPSHOT_LOCK:
+        if 'iam' not in g:
+            g['iam'] = {'roles': {}, 'policies': {}, 'profiles': {}}
+    return g['iam']
+
+# forget (or replace) what the snapshot knows about a name
+def updateIamSnapshot(g, kind, name, value=None, forget=False):
+    snapshot = getIamSnapshot(g)
+    if forget:
+        snapshot[kind].pop(name, None)
+    else:
+        snapshot[kind][name] = value
+
+# Look up kind/name in the snapshot, else call fetch (a direct get_* call),
+#  treating NoSuchEntity as "does not exist".
+def lookupIam(g, kind, name, fetch):
+    snapshot = getIamSnapshot(g)
+    if name in snapshot[kind]:
+        return snapshot[kind][name]
+
+    try:
+        value = fetch()
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchEntity':
+            raise
+        value = None
+    snapshot[kind][name] = value
+    return value
+
+# get the arn prefix (arn:<partition>:iam::<account id>:) of the caller's account
+def getIamArnPrefix(g):
+    snapshot = getIamSnapshot(g)
+    if 'arn_prefix' not in snapshot:
+        identity = g['clients'].client('sts').get_caller_identity()
+        partition = identity['Arn'].split(':')[1]
+        snapshot['arn_prefix'] = 'arn:' + partition + ':iam::' + identity['Account'] + ':'
+    return snapshot['arn_prefix']
+
+# get role dictionary (None if it doesn't exist)
+def getRole(g, role_name):
+    iam = g['clients'].client('iam')
+    return lookupIam(g, 'roles', role_name,
+        lambda: iam.get_role(RoleName=role_name)['Role'])
+
+# get instance profile dictionary (None if it doesn't exist)
+def getInstanceProfile(g, profile_name):
+    iam = g['clients'].client('iam')
+    return lookupIam(g, 'profiles', profile_name,
+        lambda: iam.get_instance_profile(InstanceProfileName=profile_name)['InstanceProfile'])
 
 # check if role exists by name
 def roleExists(g, role_name):
-    iam = g['session'].resource('iam')
-    
-    roles = iam.roles.filter(
-        PathPrefix='/'
-    )
-
-    for role in roles:
-        if role_name == role.role_name:
-            return True
-    return False
+    return getRole(g, role_name) is not None
 
 # check if policy exists by name
 def policyExists(g, policy_name):
-    policy_arn = getPolicyArn(g, policy_name)
-
-    if policy_arn:
-        return True
-    else:
-        return False
+    return getPolicy(g, policy_name) is not None
 
 # check if profile exists by name
 def profileExists(g, profile_name):
-    iam = g['session'].resource('iam')
-
-    instance_profiles = iam.instance_profiles.filter(
-        PathPrefix='/'
-    )
-    for instance_profile in instance_profiles:
-        if instance_profile.name == profile_name:
-            return True
-    return False
+    return getInstanceProfile(g, profile_name) is not None
 
 # get policy arn from policy name
 def getPolicyArn(g, policy_name):
-    iam = g['session'].client('iam')
-
-    paginator = iam.get_paginator('list_policies')
-    for response in paginator.paginate(Scope="Local"):
-        for policy in response["Policies"]:
-            if policy_name == policy['PolicyName']:
-                return policy['Arn']
+    policy = getPolicy(g, policy_name)
+    if policy:
+        return policy['Arn']
     return None
 
+# build policy arn from policy name, without checking that it exists
+#  (local policies are created with the default path '/')
+def buildPolicyArn(g, policy_name):
+    return getIamArnPrefix(g) + 'policy/' + policy_name
+
 # get policy dictionary
 def getPolicy(g, policy_name):
-    iam = g['session'].client('iam')
-
-    paginator = iam.get_paginator('list_policies')
-    for response in paginator.paginate(Scope="Local"):
-        for policy in response["Policies"]:
-            if policy_name == policy['PolicyName']:
-                return policy
-    return None
+    iam = g['clients'].client('iam')
+    return lookupIam(g, 'policies', policy_name,
+        lambda: iam.get_policy(PolicyArn=buildPolicyArn(g, policy_name))['Policy'])
 
 # check if policy has more than 0 attachments
 def policyIsAttached(g, policy_name):
-    if policyExists(g, policy_name):
-        if getPolicy(g, policy_name)['AttachmentCount']:
-            return True
-    else:
-        return False
+    policy = getPolicy(g, policy_name)
+    if policy and policy['AttachmentCount']:
+        return True
+    return False
 
 # create iam role
 def create_iam_role(g, role_name, json_file_path):
-    iam = g['session'].client('iam')
+    iam = g['clients'].client('iam')
 
     assume_role_policy_document = readFromFile(json_file_path)
 
@@ -79,20 +111,22 @@ def create_iam_role(g, role_name, json_file_path):
         AssumeRolePolicyDocument = assume_role_policy_document
     )
     #print(response)
+    updateIamSnapshot(g, 'roles', role_name, response['Role'])
     return response["Role"]["RoleName"]
 
 # delete iam role
 def delete_iam_role(g, role_name):
-    iam = g['session'].resource('iam')
+    iam = g['clients'].resource('iam')
 
     role = iam.Role(
         role_name
     )
     role.delete()
+    updateIamSnapshot(g, 'roles', role_name, None)
 
 # create iam policy
 def create_iam_policy(g, role_name, json_file_path):
-    iam = g['session'].client('iam')
+    iam = g['clients'].client('iam')
 
     # Create a policy
     policy = readFromFile(json_file_path)
@@ -102,42 +136,48 @@ def create_iam_policy(g, role_name, json_file_path):
         PolicyDocument=policy
     )
     #print(response)
+    updateIamSnapshot(g, 'policies', role_name, response['Policy'])
     return response['Policy']['Arn']
 
 # delete iam policy
 def delete_iam_policy(g, policy_name):
-    iam = g['session'].resource('iam')
+    iam = g['clients'].resource('iam')
 
     policy = iam.Policy(
-        getPolicyArn(g, policy_name)
+        buildPolicyArn(g, policy_name)
     )
     policy.delete()
+    updateIamSnapshot(g, 'policies', policy_name, None)
 
 # attach iam policy to role
 def attach_iam_policy(g, policy_name, role_name):
-    iam = g['session'].client('iam')
+    iam = g['clients'].client('iam')
 
     response = iam.attach_role_policy(
         RoleName=role_name,
-        PolicyArn=getPolicyArn(g,policy_name)
+        PolicyArn=buildPolicyArn(g, policy_name)
     )
     #print(response)
+    # attachment count changed
+    updateIamSnapshot(g, 'policies', policy_name, forget=True)
 
 # detach iam policy from role
 def detach_iam_policy(g, policy_name, role_name):
-    iam = g['session'].resource('iam')
+    iam = g['clients'].resource('iam')
 
     role = iam.Role(role_name)
 
     response = role.detach_policy(
-        PolicyArn=getPolicyArn(g, policy_name)
+        PolicyArn=buildPolicyArn(g, policy_name)
     )
     #print(response)
+    # attachment count changed
+    updateIamSnapshot(g, 'policies', policy_name, forget=True)
 
 # create instance profile (container for an iam role that is attached to ec2 instance)
 def createInstanceProfile(g):
     config = g['config']
-    iam = g['session'].client('iam')
+    iam = g['clients'].client('iam')
     
     instance_profile = config['server']['iam']['instance_profile']
 
@@ -161,27 +201,30 @@ def createInstanceProfile(g):
     attach_iam_policy(g, policy_name, role_name)
 
     
-    if not profileExists(g, instance_profile_name):
-        response = iam.create_instance_profile (
+    profile = getInstanceProfile(g, instance_profile_name)
+    if not profile:
+        profile = iam.create_instance_profile (
             InstanceProfileName = instance_profile_name 
-        )
+        )['InstanceProfile']
+        updateIamSnapshot(g, 'profiles', instance_profile_name, profile)
 
-    response = iam.get_instance_profile(
-        InstanceProfileName=instance_profile_name
-    )
-    if not response['InstanceProfile']['Roles']:
+    if not profile['Roles']:
         iam.add_role_to_instance_profile (
             InstanceProfileName = instance_profile_name,
             RoleName            = role_name 
         )
+        updateIamSnapshot(g, 'profiles', instance_profile_name, forget=True)
     
-    return { 'Arn': response['InstanceProfile']['Arn'] }
+    changes = {}
+    changes['instance_profile'] = { 'Arn': profile['Arn'] }
+    updateDeployed(g, changes)
+
+    return changes['instance_profile']
 
 # delete instance profile
 def deleteInstanceProfile(g):
     config = g['config']
-    iam = g['session'].resource('iam')
-    iam_client = g['session'].client('iam')
+    iam = g['clients'].resource('iam')
     
     instance_profile = config['server']['iam']['instance_profile']
 
@@ -189,19 +232,15 @@ def deleteInstanceProfile(g):
     policy_name = instance_profile['policy']['name']
     instance_profile_name = instance_profile['name']
 
-    if profileExists(g, instance_profile_name):
-        response = iam_client.get_instance_profile(
-            InstanceProfileName=instance_profile_name
-        )
-        
-        if response['InstanceProfile']['Roles']:
-            instance_profile = iam.InstanceProfile(instance_profile_name)
+    profile = getInstanceProfile(g, instance_profile_name)
+    if profile:
+        instance_profile = iam.InstanceProfile(instance_profile_name)
+        if profile['Roles']:
             instance_profile.remove_role(
                 RoleName=role_name
             )
-            instance_profile.delete()
-        else:
-            instance_profile.delete()
+        instance_profile.delete()
+        updateIamSnapshot(g, 'profiles', instance_profile_name, None)
 
     if policyIsAttached(g, policy_name):
         detach_iam_policy(g, policy_name, role_name)
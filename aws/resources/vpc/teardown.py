@@ -0,0 +1,293 @@
+import os, json
+from concurrent.futures import ThreadPoolExecutor
+
+from aws.resources.ec2.inventory import getInventory
+from aws.utils.clients import paginate, paginateFilterValues
+from aws.utils.retry import retryWithBackoff, getErrorCode
+from aws.utils.state import atomicWrite
+from aws.utils.utils import getCachePath
+
+
+### NOTE: teardown runs in tiers. Every node in a tier is deleted concurrently and
+##    retried on its own, and a tier only starts once the previous one is done:
+##
+##      dependents (eips, nat gateways, endpoints, peering, tgw attachments)
+##        -> instances -> enis -> security groups / nacls / subnets
+##        -> route tables -> internet gateways -> vpc
+##
+##    Deleted node ids are recorded in a progress file (under cache.directory)
+##    so a rerun after a failure only deletes what is left.
+
+# errors that mean "something still depends on this resource, try again later"
+RETRYABLE_TEARDOWN_ERRORS = [
+    'DependencyViolation',
+    'IncorrectState',
+    'InvalidNetworkInterface.InUse',
+    'ResourceInUse'
+]
+
+# raised by nodes that wait for aws to delete a resource on its own
+class NotYetDeleted(Exception):
+    pass
+
+def isRetryableTeardownError(e):
+    return isinstance(e, NotYetDeleted) or getErrorCode(e) in RETRYABLE_TEARDOWN_ERRORS
+
+# a resource that no longer exists counts as deleted
+def isNotFoundError(e):
+    return (getErrorCode(e) or '').endswith('NotFound')
+
+
+### NOTE: discovery only sends calls filtered on this vpc (vpc-id, resource-id,
+##    instance-id, ...), so its cost follows the size of the stack rather than
+##    the size of the account.
+#
+# Gather the vpc and its dependents into a plan (dict of resource lists).
+def discoverTeardownPlan(g, vpc_id):
+    ec2_client = g['clients'].client('ec2')
+    vpc_filter = [{"Name": "vpc-id", "Values": [vpc_id]}]
+
+    plan = {}
+    plan['vpc_id'] = vpc_id
+
+    # every (non terminated) instance in the vpc, from one paginated describe_instances
+    inventory = getInventory(g, vpc_id)
+    plan['instances'] = inventory.ids()
+
+    # eips of all instances (filter values are sent in chunks, see aws/utils/clients.py)
+    plan['addresses'] = [
+        {'AllocationId': eip['AllocationId'], 'AssociationId': eip.get('AssociationId')}
+        for eip in paginateFilterValues(ec2_client, 'describe_addresses', 'Addresses', 'instance-id', plan['instances'])
+    ]
+
+    # note - this only handles vpc attachments, not vpn
+    plan['tgw_attachments'] = [
+        attachment['TransitGatewayAttachmentId']
+        for attachment in paginate(ec2_client, 'describe_transit_gateway_attachments', 'TransitGatewayAttachments',
+            Filters=[
+                {"Name": "resource-id", "Values": [vpc_id]},
+                {"Name": "resource-type", "Values": ["vpc"]},
+                {"Name": "state", "Values": ["available", "pending", "pendingAcceptance", "modifying"]}
+            ])
+    ]
+
+    plan['nat_gateways'] = [
+        nat_gateway['NatGatewayId']
+        for nat_gateway in paginate(ec2_client, 'describe_nat_gateways', 'NatGateways',
+            Filter=vpc_filter + [{"Name": "state", "Values": ["pending", "available", "failed"]}])
+    ]
+
+    plan['endpoints'] = [
+        ep['VpcEndpointId']
+        for ep in paginate(ec2_client, 'describe_vpc_endpoints', 'VpcEndpoints', Filters=vpc_filter)
+    ]
+
+    # this vpc can be either side of a peering connection
+    plan['peering'] = []
+    for side in ['accepter-vpc-info.vpc-id', 'requester-vpc-info.vpc-id']:
+        for vpc_peer in paginate(ec2_client, 'describe_vpc_peering_connections', 'VpcPeeringConnections',
+                Filters=[{"Name": side, "Values": [vpc_id]}]):
+            if vpc_peer['VpcPeeringConnectionId'] not in plan['peering']:
+                plan['peering'].append(vpc_peer['VpcPeeringConnectionId'])
+
+    plan['network_interfaces'] = [
+        {'id': interface['NetworkInterfaceId'], 'requester_managed': interface.get('RequesterManaged', False)}
+        for interface in paginate(ec2_client, 'describe_network_interfaces', 'NetworkInterfaces', Filters=vpc_filter)
+    ]
+
+    plan['security_groups'] = [
+        sg['GroupId']
+        for sg in paginate(ec2_client, 'describe_security_groups', 'SecurityGroups', Filters=vpc_filter)
+        if sg['GroupName'] != 'default'
+    ]
+
+    plan['network_acls'] = [
+        netacl['NetworkAclId']
+        for netacl in paginate(ec2_client, 'describe_network_acls', 'NetworkAcls',
+            Filters=vpc_filter + [{"Name": "default", "Values": ["false"]}])
+    ]
+
+    plan['subnets'] = [
+        subnet['SubnetId']
+        for subnet in paginate(ec2_client, 'describe_subnets', 'Subnets', Filters=vpc_filter)
+    ]
+
+    plan['route_tables'] = []
+    for route_table in paginate(ec2_client, 'describe_route_tables', 'RouteTables', Filters=vpc_filter):
+        plan['route_tables'].append({
+            'id': route_table['RouteTableId'],
+            'main': any(association['Main'] for association in route_table['Associations']),
+            'routes': [
+                route['DestinationCidrBlock'] for route in route_table['Routes']
+                if route['Origin'] == 'CreateRoute' and 'DestinationCidrBlock' in route
+            ],
+            'associations': [
+                association['RouteTableAssociationId'] for association in route_table['Associations']
+                if not association['Main']
+            ]
+        })
+
+    plan['internet_gateways'] = [
+        gw['InternetGatewayId']
+        for gw in paginate(ec2_client, 'describe_internet_gateways', 'InternetGateways',
+            Filters=[{"Name": "attachment.vpc-id", "Values": [vpc_id]}])
+    ]
+
+    return plan
+
+# Build the ordered tiers of (node id, delete function) from a plan.
+def getTeardownTiers(g, plan):
+    ec2_client = g['clients'].client('ec2')
+    vpc_id = plan['vpc_id']
+
+    def releaseAddress(eip):
+        if eip['AssociationId']:
+            ec2_client.disassociate_address(AssociationId=eip['AssociationId'])
+        ec2_client.release_address(AllocationId=eip['AllocationId'])
+        print('  released eip ' + eip['AllocationId'])
+
+    def deleteTgwAttachment(attachment_id):
+        ec2_client.delete_transit_gateway_vpc_attachment(TransitGatewayAttachmentId=attachment_id)
+        print('  deleted transit gateway attachment ' + attachment_id)
+
+    # attached ENIs are deleted by aws (waited for in the eni tier)
+    def deleteNatGateway(nat_gateway_id):
+        ec2_client.delete_nat_gateway(NatGatewayId=nat_gateway_id)
+        print('  deleting nat gateway ' + nat_gateway_id)
+
+    def deleteEndpoint(endpoint_id):
+        ec2_client.delete_vpc_endpoints(VpcEndpointIds=[endpoint_id])
+        print('  deleting vpc endpoint ' + endpoint_id)
+
+    def deletePeering(peering_id):
+        ec2_client.delete_vpc_peering_connection(VpcPeeringConnectionId=peering_id)
+        print('  deleted vpc peering connection ' + peering_id)
+
+    def terminateInstances(instance_ids):
+        print('  terminating ec2 instances')
+        ec2_client.terminate_instances(InstanceIds=instance_ids)
+        print('  waiting for ec2 instances to be terminated')
+        ec2_client.get_waiter('instance_terminated').wait(InstanceIds=instance_ids)
+        print('  ec2 instances terminated')
+
+    # requester managed ENIs (nat gateways, endpoints) are deleted by aws, so only wait for those
+    def deleteNetworkInterface(interface):
+        if interface['requester_managed']:
+            ec2_client.describe_network_interfaces(NetworkInterfaceIds=[interface['id']])
+            raise NotYetDeleted(interface['id'])
+        ec2_client.delete_network_interface(NetworkInterfaceId=interface['id'])
+        print('  deleted network interface ' + interface['id'])
+
+    def deleteSecurityGroup(group_id):
+        ec2_client.delete_security_group(GroupId=group_id)
+        print('  deleted security group ' + group_id)
+
+    def deleteNetworkAcl(network_acl_id):
+        ec2_client.delete_network_acl(NetworkAclId=network_acl_id)
+        print('  deleted nacl ' + network_acl_id)
+
+    def deleteSubnet(subnet_id):
+        ec2_client.delete_subnet(SubnetId=subnet_id)
+        print('  deleted subnet ' + subnet_id)
+
+    # the main route table is deleted along with the vpc, only its routes are removed
+    def deleteRouteTable(route_table):
+        for cidr in route_table['routes']:
+            ignoreNotFound(lambda: ec2_client.delete_route(RouteTableId=route_table['id'], DestinationCidrBlock=cidr))
+        for association_id in route_table['associations']:
+            ignoreNotFound(lambda: ec2_client.disassociate_route_table(AssociationId=association_id))
+        if not route_table['main']:
+            ec2_client.delete_route_table(RouteTableId=route_table['id'])
+            print('  deleted route table ' + route_table['id'])
+
+    def deleteInternetGateway(gateway_id):
+        ignoreNotFound(lambda: ec2_client.detach_internet_gateway(InternetGatewayId=gateway_id, VpcId=vpc_id))
+        ec2_client.delete_internet_gateway(InternetGatewayId=gateway_id)
+        print('  deleted internet gateway ' + gateway_id)
+
+    def deleteVpc(vpc_id):
+        ec2_client.delete_vpc(VpcId=vpc_id)
+        print('  deleted vpc ' + vpc_id)
+
+    dependents = []
+    dependents += [('eip:' + eip['AllocationId'], lambda eip=eip: releaseAddress(eip)) for eip in plan['addresses']]
+    dependents += [('tgw-attachment:' + i, lambda i=i: deleteTgwAttachment(i)) for i in plan['tgw_attachments']]
+    dependents += [('nat-gateway:' + i, lambda i=i: deleteNatGateway(i)) for i in plan['nat_gateways']]
+    dependents += [('endpoint:' + i, lambda i=i: deleteEndpoint(i)) for i in plan['endpoints']]
+    dependents += [('peering:' + i, lambda i=i: deletePeering(i)) for i in plan['peering']]
+
+    instances = []
+    if plan['instances']:
+        instances.append(('instances:' + ','.join(sorted(plan['instances'])), lambda: terminateInstances(plan['instances'])))
+
+    interfaces = [('eni:' + i['id'], lambda i=i: deleteNetworkInterface(i)) for i in plan['network_interfaces']]
+
+    groups_acls_subnets = []
+    groups_acls_subnets += [('sg:' + i, lambda i=i: deleteSecurityGroup(i)) for i in plan['security_groups']]
+    groups_acls_subnets += [('nacl:' + i, lambda i=i: deleteNetworkAcl(i)) for i in plan['network_acls']]
+    groups_acls_subnets += [('subnet:' + i, lambda i=i: deleteSubnet(i)) for i in plan['subnets']]
+
+    route_tables = [('route-table:' + rt['id'], lambda rt=rt: deleteRouteTable(rt)) for rt in plan['route_tables']]
+
+    gateways = [('igw:' + i, lambda i=i: deleteInternetGateway(i)) for i in plan['internet_gateways']]
+
+    return [
+        ('dependents', dependents),
+        ('instances', instances),
+        ('network interfaces', interfaces),
+        ('security groups, nacls and subnets', groups_acls_subnets),
+        ('route tables', route_tables),
+        ('internet gateways', gateways),
+        ('vpc', [('vpc:' + vpc_id, lambda: deleteVpc(vpc_id))])
+    ]
+
+# call fn, ignoring errors for resources that are already gone
+def ignoreNotFound(fn):
+    try:
+        fn()
+    except Exception as e:
+        if not isNotFoundError(e):
+            raise
+
+# get path of the teardown progress file for vpc_id
+def getTeardownProgressPath(g, vpc_id):
+    return getCachePath(g, 'teardown-' + vpc_id + '.json')
+
+def readTeardownProgress(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as handle:
+        return json.load(handle)
+
+# Delete every node of every tier, concurrently within a tier, retrying each node on its own.
+def runTeardownPlan(g, plan):
+    max_workers = g['config'].get('scheduler', {}).get('max_workers', 4)
+    progress_path = getTeardownProgressPath(g, plan['vpc_id'])
+    deleted = readTeardownProgress(progress_path)
+
+    def deleteNode(node_id, fn):
+        retryWithBackoff(lambda: ignoreNotFound(fn), isRetryableTeardownError, node_id,
+            base=2, cap=30, deadline_seconds=600)
+        return node_id
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for tier_name, nodes in getTeardownTiers(g, plan):
+            nodes = [(node_id, fn) for node_id, fn in nodes if node_id not in deleted]
+            if not nodes:
+                continue
+
+            print('deleting ' + tier_name)
+            futures = [executor.submit(deleteNode, node_id, fn) for node_id, fn in nodes]
+            error = None
+            for future in futures:
+                try:
+                    deleted.append(future.result())
+                except Exception as e:
+                    error = error or e
+            atomicWrite(progress_path, json.dumps(deleted, indent=4))
+
+            if error is not None:
+                raise error
+
+    os.remove(progress_path)
+    print('vpc deleted')
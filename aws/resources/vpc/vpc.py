@@ -1,11 +1,14 @@
-import time
+from concurrent.futures import ThreadPoolExecutor
 
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, WaiterError
+
+from aws.utils.retry import retryWithBackoff, getErrorCode
+from aws.resources.vpc.teardown import discoverTeardownPlan, runTeardownPlan
 
 
 # check if vpc exists by vpc_id
 def vpc_exists(g, vpc_id):
-    ec2_client = g['session'].client('ec2')
+    ec2_client = g['clients'].client('ec2')
     try:
         ec2_client.describe_vpcs(VpcIds=[vpc_id])
     except ClientError as e:
@@ -15,8 +18,8 @@ def vpc_exists(g, vpc_id):
 
 # check if vpc exists, filtering on cidr and tag:Name
 def getVpcByTagsAndCidr(g):
-    ec2_resource = g['session'].resource('ec2')
-    ec2_client = g['session'].client('ec2')
+    ec2_resource = g['clients'].resource('ec2')
+    ec2_client = g['clients'].client('ec2')
 
     vpc_tags = []
     for _tag in g['config']['vpc']['tags']:
@@ -43,17 +46,21 @@ def getVpcByTagsAndCidr(g):
     )
 
     if response['Vpcs']:
-        filters = [{'Name':'cidr-block-association.cidr-block', 'Values':[g['config']['vpc']['cidr']]}]
-        vpcs = list(ec2_resource.vpcs.filter(Filters=filters))
-        return vpcs[0]
+        # reuse the describe_vpcs data instead of loading the vpc again
+        vpc = ec2_resource.Vpc(response['Vpcs'][0]['VpcId'])
+        vpc.meta.data = response['Vpcs'][0]
+        return vpc
     else:
         return None
 
 # get subnets by tags from config.yaml
-def getSubnetsByTag(g):
-    ec2_resource = g['session'].resource('ec2')
+def getSubnetsByTag(g, vpc_id=None):
+    ec2_resource = g['clients'].resource('ec2')
 
     subnet_filters = []
+    # only the subnets of this vpc (other vpcs may have subnets with the same tags)
+    if vpc_id:
+        subnet_filters.append({'Name': 'vpc-id', 'Values': [vpc_id]})
     for _tag in g['config']['server']['subnet']['tags']:
         tag_filter = {}
         tag_filter['Name'] = 'tag:' +_tag['key']
@@ -64,204 +71,47 @@ def getSubnetsByTag(g):
     subnets = list(ec2_resource.subnets.filter(Filters=subnet_filters))
     return subnets
 
-# destroy vpc and all ec2 instances in it
+# destroy vpc and all ec2 instances in it (see aws/resources/vpc/teardown.py)
 def teardown(g):
-    ec2_client = g['session'].client('ec2')
-
     vpc = getVpcByTagsAndCidr(g)
     if not vpc:
         print('vpc doesn\'t exist')
     else:
         print(vpc)
-        vpc_id = vpc.id
-
-        try:
-            # disassociate and release EIPs from EC2 instances
-            for subnet in vpc.subnets.all():
-                print(subnet)
-                for instance in subnet.instances.all():
-                    print(instance)
-                    filters = [{"Name": "instance-id", "Values": [instance.id]}]
-                    eips = ec2_client.describe_addresses(Filters=filters)["Addresses"]
-                    for eip in eips:
-                        ec2_client.disassociate_address(AssociationId=eip["AssociationId"])
-                        ec2_client.release_address(AllocationId=eip["AllocationId"])
-                        print('    disassociating and releasing EIPs from ec2 instances')
-            
-            ## terminate EC2 instances
-
-            # get instances that are running in vpc
-            filters = [
-                {"Name": "instance-state-name", "Values": ["running"]},
-                {"Name": "vpc-id", "Values": [vpc_id]},
-            ]
-
-            # add instances to list
-            ec2_instances = ec2_client.describe_instances(Filters=filters)
-            instance_ids = []
-            for reservation in ec2_instances["Reservations"]:
-                instance_ids += [instance["InstanceId"] for instance in reservation["Instances"]]
-            
-            # begin terminating instances and wait for completion
-            print('terminating ec2 instances')
-            print('waiting for ec2 instances to be terminated')
-            if instance_ids:
-                waiter = ec2_client.get_waiter("instance_terminated")
-                ec2_client.terminate_instances(InstanceIds=instance_ids)
-                waiter.wait(InstanceIds=instance_ids)
-            print('ec2 instances terminated')
-            
-            ## move on to other VPC specific resources
-            print('deleting other vpc specific subresources')
-            # delete transit gateway attachment for this vpc
-            # note - this only handles vpc attachments, not vpn
-            for attachment in ec2_client.describe_transit_gateway_attachments()[
-                "TransitGatewayAttachments"
-            ]:
-                if attachment["ResourceId"] == vpc_id:
-                    ec2_client.delete_transit_gateway_vpc_attachment(
-                        TransitGatewayAttachmentId=attachment["TransitGatewayAttachmentId"]
-                    )
-                    print('  deleting transit gateway attachement for this vpc')
-
-            # delete NAT Gateways
-            # attached ENIs are automatically deleted
-            # EIPs are disassociated but not released
-            filters = [{"Name": "vpc-id", "Values": [vpc_id]}]
-            for nat_gateway in ec2_client.describe_nat_gateways(Filters=filters)["NatGateways"]:
-                ec2_client.delete_nat_gateway(NatGatewayId=nat_gateway["NatGatewayId"])
-                print('  deleting nat gateway')
-
-            ec2_resource = g['session'].resource('ec2')
-
-            # detach default dhcp_options if associated with the vpc
-            dhcp_options_default = ec2_resource.DhcpOptions("default")
-            if dhcp_options_default:
-                dhcp_options_default.associate_with_vpc(VpcId=vpc.id)
-                print('  detaching default dhcp_options associated with vpc')
-
-            # delete any vpc peering connections
-            for vpc_peer in ec2_client.describe_vpc_peering_connections()[
-                "VpcPeeringConnections"
-            ]:
-                if vpc_peer["AccepterVpcInfo"]["VpcId"] == vpc_id:
-                    ec2_resource.VpcPeeringConnection(vpc_peer["VpcPeeringConnectionId"]).delete()
-                    print('  deleting vpc peering connection')
-                if vpc_peer["RequesterVpcInfo"]["VpcId"] == vpc_id:
-                    ec2_resource.VpcPeeringConnection(vpc_peer["VpcPeeringConnectionId"]).delete()
-                    print('  deleting vpc peering connection')
-
-            # delete our endpoints
-            for ep in ec2_client.describe_vpc_endpoints(
-                Filters=[{"Name": "vpc-id", "Values": [vpc_id]}]
-            )["VpcEndpoints"]:
-                ec2_client.delete_vpc_endpoints(VpcEndpointIds=[ep["VpcEndpointId"]])
-                print('  deleting vpc endpoint')
-
-            # delete custom security groups
-            for sg in vpc.security_groups.all():
-                if sg.group_name != "default":
-                    sg.delete()
-                    print('  deleting security group')
-
-            # delete custom NACLs
-            for netacl in vpc.network_acls.all():
-                if not netacl.is_default:
-                    netacl.delete()
-                    print('  deleting nacl')
-
-            # ensure ENIs are deleted before proceding
-            timeout = time.time() + 300
-            filter = [{"Name": "vpc-id", "Values": [vpc_id]}]
-            reached_timeout = True
-            while time.time() < timeout:
-                if not ec2_client.describe_network_interfaces(Filters=filters)[
-                    "NetworkInterfaces"
-                ]:
-                    print('  no enis remaining')
-                    reached_timeout = False
-                    break
-                else:
-                    print('    waiting for enis to delete') 
-                    time.sleep(30)
-
-            if reached_timeout:
-                print('     ENI deletion timed out')
-
-            # delete subnets
-            for subnet in vpc.subnets.all():
-                for interface in subnet.network_interfaces.all():
-                    interface.delete()
-                    print('  deleting network interface')
-                subnet.delete()
-
-            # Delete routes, associations, and routing tables
-            filter = [{"Name": "vpc-id", "Values": [vpc_id]}]
-            route_tables = ec2_client.describe_route_tables(Filters=filter)["RouteTables"]
-            for route_table in route_tables:
-                for route in route_table["Routes"]:
-                    if route["Origin"] == "CreateRoute":
-                        ec2_client.delete_route(
-                            RouteTableId=route_table["RouteTableId"],
-                            DestinationCidrBlock=route["DestinationCidrBlock"],
-                        )
-                        print('  deleting route in route table')
-                    for association in route_table["Associations"]:
-                        if not association["Main"]:
-                            ec2_client.disassociate_route_table(
-                                AssociationId=association["RouteTableAssociationId"] #### ERROR encountered #### botocore.exceptions.ClientError: An error occurred (InvalidAssociationID.NotFound) when calling the DisassociateRouteTable operation: The association ID 'rtbassoc-02082ff9ee5b78c6c' does not exist
-                            )
-                            print('  disassociating route table\'s association to subnet')
-                            
-                            ec2_client.delete_route_table(
-                                RouteTableId=route_table["RouteTableId"]  ##### ERROR encountered #####
-                            )
-                            print('  deleting route table')
-
-            # delete routing tables without associations
-            for route_table in route_tables:
-                if route_table["Associations"] == []:
-                    ec2_client.delete_route_table(RouteTableId=route_table["RouteTableId"])
-                    print('  deleting route table without associations')
-
-            # destroy NAT gateways
-            filters = [{"Name": "vpc-id", "Values": [vpc_id]}]
-            nat_gateway_ids = [
-                nat_gateway["NatGatewayId"]
-                for nat_gateway in ec2_client.describe_nat_gateways(Filters=filters)[
-                    "NatGateways"
-                ]
-            ]
-            for nat_gateway_id in nat_gateway_ids:
-                ec2_client.delete_nat_gateway(NatGatewayId=nat_gateway_id)
-                print('  deleting nat gateway')
+        plan = discoverTeardownPlan(g, vpc.id)
+        runTeardownPlan(g, plan)
 
-            # detach and delete all IGWs associated with the vpc
-            for gw in vpc.internet_gateways.all():
-                vpc.detach_internet_gateway(InternetGatewayId=gw.id)
-                print('  detaching internet gateway from vpc')
-                gw.delete()
-                print('  deleting internet gateway')
-
-            ec2_client.delete_vpc(VpcId=vpc_id)
-            print('  deleting vpc')
-            print('vpc deleted')
-        except Exception as e:
-            print()
-            print(e)
-            print('error occurred, retrying...')
-            time.sleep(6)
-            print()
-            teardown(g)
+# convert config.yaml tags (key/value) to aws tags (Key/Value)
+def getTagsFromConfig(config_tags):
+    tags = []
+    for _tag in config_tags:
+        tag = {}
+        tag['Key'] = _tag['key']
+        tag['Value'] = _tag['value']
+        tags.append(tag)
+    return tags
+
+# Wait on an ec2 waiter, polling every 2 seconds. A resource that was just created can
+#  briefly be reported as NotFound (eventual consistency), which is retried.
+def waitUntil(ec2_client, waiter_name, **kwargs):
+    waiter = ec2_client.get_waiter(waiter_name)
+    retryWithBackoff(
+        lambda: waiter.wait(WaiterConfig={'Delay': 2, 'MaxAttempts': 60}, **kwargs),
+        lambda e: isinstance(e, WaiterError) and 'NotFound' in str(e),
+        waiter_name, base=0.5, cap=5, deadline_seconds=60
+    )
 
 # create custom vpc, handling when vpc already exists
 def createCustomVpc(g):
-    ec2_resource = g['session'].resource('ec2')
-    ec2_client = g['session'].client('ec2')
+    ec2_resource = g['clients'].resource('ec2')
+    ec2_client = g['clients'].client('ec2')
 
-    vpc = ec2_resource.create_vpc(CidrBlock=g['config']['vpc']['cidr'])
-    time.sleep(5)
-    vpc.wait_until_available()
+    vpc_tags = getTagsFromConfig(g['config']['vpc']['tags'])
+    vpc = ec2_resource.create_vpc(
+        CidrBlock=g['config']['vpc']['cidr'],
+        TagSpecifications=[{'ResourceType': 'vpc', 'Tags': vpc_tags}]
+    )
+    waitUntil(ec2_client, 'vpc_available', VpcIds=[vpc.id])
 
     # enable for public dns for ec2
     ec2_client.modify_vpc_attribute(
@@ -277,49 +127,47 @@ def createCustomVpc(g):
         },
         VpcId=vpc.id
     )
-    
-    # tag the vpc
-    vpc_tags = []
-    for _tag in g['config']['vpc']['tags']:
-        tag = {}
-        tag['Key'] = _tag['key']
-        tag['Value'] = _tag['value']
-        vpc_tags.append(tag)
-    vpc.create_tags(Tags=vpc_tags) #(Tags=[{"Key": "Name", "Value": "default_vpc"}])
 
     # create and attach internet gateway
     ig = ec2_resource.create_internet_gateway()
     vpc.attach_internet_gateway(InternetGatewayId=ig.id)
 
-    # add route to routetable (one created by default for vpc) for internet gateway
-    for route_table in vpc.route_tables.all():
-        route_table.create_route(DestinationCidrBlock='0.0.0.0/0', GatewayId=ig.id)
-    
-    subnets = []
-    # create subnets
-    for sn in g['config']['vpc']['subnets']:
-        # create subnet
-        subnet = ec2_resource.create_subnet(CidrBlock=sn['cidr'], VpcId=vpc.id, AvailabilityZone=sn['availability_zone'])
-        time.sleep(2)
-        subnets.append(subnet)
-
-    for sn in subnets:
-        # associate the route table with the subnet
-        route_table.associate_with_subnet(SubnetId=sn.id)
-        time.sleep(2)
-
-    # tag subnets
-    i = 0
-    for sn in subnets:
-        subnet_tags = []
-        for _tag in g['config']['vpc']['subnets'][i]['tags']:
-            tag = {}
-            tag['Key'] = _tag['key']
-            tag['Value'] = _tag['value']
-            subnet_tags.append(tag)
-            i += 1
+    # add route to main routetable (one created by default for vpc) for internet gateway
+    route_table = ec2_client.describe_route_tables(
+        Filters=[
+            {'Name': 'vpc-id', 'Values': [vpc.id]},
+            {'Name': 'association.main', 'Values': ['true']}
+        ]
+    )['RouteTables'][0]
+    ec2_client.create_route(RouteTableId=route_table['RouteTableId'], DestinationCidrBlock='0.0.0.0/0', GatewayId=ig.id)
+
+    # create (tagged) subnet, associate it with the route table and wait until it is available
+    def createSubnet(sn):
+        subnet = ec2_client.create_subnet(
+            CidrBlock=sn['cidr'],
+            VpcId=vpc.id,
+            AvailabilityZone=sn['availability_zone'],
+            TagSpecifications=[{'ResourceType': 'subnet', 'Tags': getTagsFromConfig(sn['tags'])}]
+        )['Subnet']
+        retryWithBackoff(
+            lambda: ec2_client.associate_route_table(RouteTableId=route_table['RouteTableId'], SubnetId=subnet['SubnetId']),
+            lambda e: (getErrorCode(e) or '').endswith('NotFound'),
+            'route table association', base=0.5, cap=5, deadline_seconds=60
+        )
+        waitUntil(ec2_client, 'subnet_available', SubnetIds=[subnet['SubnetId']])
+        return subnet
+
+    # create subnets concurrently
+    subnet_configs = g['config']['vpc']['subnets']
+    max_workers = g['config'].get('scheduler', {}).get('max_workers', 4)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(subnet_configs)))) as executor:
+        created = list(executor.map(createSubnet, subnet_configs))
 
-        subnet.create_tags(Tags=subnet_tags)
+    subnets = []
+    for subnet in created:
+        sn = ec2_resource.Subnet(subnet['SubnetId'])
+        sn.meta.data = subnet
+        subnets.append(sn)
     
     # create sec group
     security_group = ec2_resource.create_security_group(
@@ -364,7 +212,7 @@ def createVPC(g):
     if vpc:
         print('vpc exists')
         
-        subnets = getSubnetsByTag(g)
+        subnets = getSubnetsByTag(g, vpc.id)
 
         security_groups = []
         for sg in vpc.security_groups.all():
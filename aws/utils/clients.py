@@ -0,0 +1,97 @@
+import threading
+
+from botocore.config import Config
+
+
+# defaults for the optional 'boto' section of config.yaml
+BOTO_CONFIG_DEFAULTS = {
+    'max_pool_connections': 20,
+    'retry_mode': 'adaptive',
+    'max_attempts': 10,
+    'connect_timeout': 10,
+    'read_timeout': 60
+}
+
+# build a botocore Config from the 'boto' section of config.yaml
+def getBotoConfig(config):
+    settings = dict(BOTO_CONFIG_DEFAULTS)
+    settings.update(config.get('boto') or {})
+
+    return Config(
+        max_pool_connections=settings['max_pool_connections'],
+        retries={
+            'mode': settings['retry_mode'],
+            'max_attempts': settings['max_attempts']
+        },
+        connect_timeout=settings['connect_timeout'],
+        read_timeout=settings['read_timeout']
+    )
+
+
+### NOTE: boto3 clients are thread-safe and are shared by every thread.
+##    boto3 resources (and sessions) are not, so each thread gets its own
+##    resource object, but it is rebound to the shared (pooled) client.
+#
+# Builds each client/resource once per (service, region) and hands out the cached one.
+class ClientRegistry:
+    def __init__(self, session, config):
+        self.session = session
+        self.boto_config = getBotoConfig(config)
+        self.clients = {}
+        self.clients_built = 0
+        self.resources_built = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    # get (or build) the shared client for service in region
+    def client(self, service, region=None):
+        key = (service, region or self.session.region_name)
+        with self._lock:
+            if key not in self.clients:
+                self.clients[key] = self.session.client(service, region_name=key[1], config=self.boto_config)
+                self.clients_built += 1
+            return self.clients[key]
+
+    # get (or build) this thread's resource for service in region
+    def resource(self, service, region=None):
+        key = (service, region or self.session.region_name)
+        resources = getattr(self._local, 'resources', None)
+        if resources is None:
+            resources = self._local.resources = {}
+
+        if key not in resources:
+            client = self.client(service, key[1])
+            with self._lock:
+                resource = self.session.resource(service, region_name=key[1], config=self.boto_config)
+                self.resources_built += 1
+            resource.meta.client = client
+            resources[key] = resource
+        return resources[key]
+
+    # print how many clients and resources were built
+    def report(self):
+        print('boto3 clients built: ' + str(self.clients_built) + ', resources built: ' + str(self.resources_built))
+
+# Yield every item under key from a (paginated) describe/list call.
+#  Calls without a paginator in this botocore version are made once.
+def paginate(client, operation, key, **kwargs):
+    if client.can_paginate(operation):
+        pages = client.get_paginator(operation).paginate(**kwargs)
+    else:
+        pages = [getattr(client, operation)(**kwargs)]
+
+    for page in pages:
+        for item in page[key]:
+            yield item
+
+# most describe calls accept at most 200 values per filter
+FILTER_VALUES_LIMIT = 200
+
+# Yield every item under key from a (paginated) describe call filtered on name in values,
+#  sending the filter values in chunks of FILTER_VALUES_LIMIT.
+def paginateFilterValues(client, operation, key, name, values, **kwargs):
+    values = list(values)
+    for i in range(0, len(values), FILTER_VALUES_LIMIT):
+        filters = [{'Name': name, 'Values': values[i:i + FILTER_VALUES_LIMIT]}]
+        for item in paginate(client, operation, key, Filters=filters, **kwargs):
+            yield item
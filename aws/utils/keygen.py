@@ -0,0 +1,115 @@
+import os, uuid, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+
+### NOTE: key generation workers are spawned, not forked: keys are generated while
+##    other scheduler threads are running, and forking a process with live threads
+##    is unsafe. A spawned worker re-imports the main script (deploy.py, as
+##    __mp_main__), which pulls in boto3, paramiko and the rest of the tool, so
+##    each worker pays that import cost once on startup. The run itself only starts
+##    in deploy.py's __main__ block, so workers don't deploy anything.
+
+# get (algorithm, bits) for a key from its config.yaml ssh_key entry (default rsa 4096)
+def getKeySpec(ssh_key):
+    algorithm = ssh_key.get('algorithm', 'rsa')
+    if algorithm == 'ed25519':
+        return ('ed25519', None)
+    elif algorithm == 'rsa':
+        return ('rsa', ssh_key.get('bits', 4096))
+    else:
+        raise ValueError('unsupported ssh key algorithm: ' + str(algorithm))
+
+# Generate a key pair. Returns the private key (openssh or pem text) and the
+#  public key as an authorized_keys line without comment (eg. 'ssh-ed25519 AAAA...').
+def generate_key(spec):
+    algorithm, bits = spec
+    if algorithm == 'ed25519':
+        key = ed25519.Ed25519PrivateKey.generate()
+        private_format = serialization.PrivateFormat.OpenSSH
+    else:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=bits)
+        private_format = serialization.PrivateFormat.TraditionalOpenSSL
+
+    private_key = key.private_bytes(
+        serialization.Encoding.PEM,
+        private_format,
+        serialization.NoEncryption()
+    ).decode()
+    public_key = key.public_key().public_bytes(
+        serialization.Encoding.OpenSSH,
+        serialization.PublicFormat.OpenSSH
+    ).decode()
+    return private_key, public_key
+
+# Generate one key pair per spec, on a (spawned) process pool when there is more than one.
+def generateKeys(specs, max_workers=None):
+    if len(specs) <= 1:
+        return [generate_key(spec) for spec in specs]
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return list(executor.map(generate_key, specs))
+
+
+### NOTE: the key pool holds pre-generated pairs as <pool>/<algorithm>-<bits>/<id>.pem/.pub.
+##    A pair is claimed by renaming its .pem out of the pool directory, which is atomic,
+##    so two runs can never draw the same key.
+
+# get the pool directory for a key spec
+def getKeyPoolDirectory(pool_directory, spec):
+    algorithm, bits = spec
+    return pool_directory + os.sep + algorithm + ('-' + str(bits) if bits else '')
+
+# Take a pre-generated key pair for spec out of the pool (None if the pool is empty).
+def takePooledKey(pool_directory, spec):
+    directory = getKeyPoolDirectory(pool_directory, spec)
+    if not os.path.isdir(directory):
+        return None
+
+    for entry in sorted(os.listdir(directory)):
+        # skip pairs being claimed (.claimed-*) or written by other runs
+        if not entry.endswith('.pem') or entry.startswith('.'):
+            continue
+        claimed = directory + os.sep + '.claimed-' + entry
+        try:
+            os.rename(directory + os.sep + entry, claimed)
+        except OSError:
+            # claimed by another run
+            continue
+
+        with open(claimed) as handle:
+            private_key = handle.read()
+        public_key_path = directory + os.sep + entry.replace('.pem', '.pub')
+        with open(public_key_path) as handle:
+            public_key = handle.read().strip()
+        os.remove(claimed)
+        os.remove(public_key_path)
+        return private_key, public_key
+    return None
+
+# count the key pairs ready in the pool for spec
+def countPooledKeys(pool_directory, spec):
+    directory = getKeyPoolDirectory(pool_directory, spec)
+    if not os.path.isdir(directory):
+        return 0
+    return len([entry for entry in os.listdir(directory) if entry.endswith('.pem') and not entry.startswith('.')])
+
+# Generate key pairs until the pool holds size pairs for every spec.
+#  The .pub file is written first, so a .pem in the pool always has its .pub.
+def refillKeyPool(pool_directory, specs, size, max_workers=None):
+    missing = []
+    for spec in set(specs):
+        missing += [spec] * max(0, size - countPooledKeys(pool_directory, spec))
+    if not missing:
+        return
+
+    for spec, (private_key, public_key) in zip(missing, generateKeys(missing, max_workers)):
+        directory = getKeyPoolDirectory(pool_directory, spec)
+        os.makedirs(directory, exist_ok=True)
+        name = directory + os.sep + uuid.uuid4().hex
+        with os.fdopen(os.open(name + '.pub', os.O_WRONLY | os.O_CREAT, 0o600), 'w') as handle:
+            handle.write(public_key)
+        with os.fdopen(os.open(name + '.pem.tmp', os.O_WRONLY | os.O_CREAT, 0o600), 'w') as handle:
+            handle.write(private_key)
+        os.replace(name + '.pem.tmp', name + '.pem')
@@ -0,0 +1,110 @@
+import sys, time, select
+
+from aws.utils.sshpool import getSSHPool
+from aws.utils.utils import getStateStore
+
+
+### NOTE: all channels are read from one thread with select(), without blocking.
+##    stdout and stderr are both drained as data arrives (so a chatty command can't
+##    fill the channel window and stall), and only the current partial line of
+##    each stream is kept in memory.
+
+# bytes read per recv call, and the longest partial line kept before it is printed anyway
+READ_SIZE = 32768
+MAX_LINE_BYTES = 65536
+
+# exit status recorded for hosts that could not be reached or timed out
+STATUS_FAILED = -1
+
+# print complete lines of a stream buffer, prefixed with the host name; return the rest
+def flushLines(hostname, buffer, stream, final=False):
+    lines = buffer.split(b'\n')
+    rest = lines.pop()
+    if final or len(rest) > MAX_LINE_BYTES:
+        if rest:
+            lines.append(rest)
+        rest = b''
+    for line in lines:
+        print(hostname + ' | ' + line.decode(errors='replace').rstrip('\r'), file=stream, flush=True)
+    return rest
+
+# open a channel on the host's pooled connection and start command on it
+def startCommand(g, hostname, command):
+    transport = getSSHPool(g).get(hostname).get_transport()
+    channel = transport.open_session()
+    channel.exec_command(command)
+    channel.setblocking(0)
+    return channel
+
+# Run command on every host (at most max_concurrency at once), streaming each host's
+#  stdout/stderr line by line. Returns {hostname: exit status}; hosts that failed to
+#  connect or ran past timeout seconds get STATUS_FAILED.
+def runOnHosts(g, hostnames, command, max_concurrency=10, timeout=None):
+    pending = list(hostnames)
+    active = {}
+    statuses = {}
+
+    while pending or active:
+        # start commands while there are free slots
+        while pending and len(active) < max_concurrency:
+            hostname = pending.pop(0)
+            try:
+                channel = startCommand(g, hostname, command)
+            except Exception as e:
+                getSSHPool(g).discard(hostname)
+                print(hostname + ' | connection failed: ' + str(e), file=sys.stderr, flush=True)
+                statuses[hostname] = STATUS_FAILED
+                continue
+            active[channel] = {'hostname': hostname, 'started': time.time(), 'stdout': b'', 'stderr': b''}
+
+        if not active:
+            continue
+
+        readable, _, _ = select.select(list(active), [], [], 0.5)
+        for channel in list(active):
+            state = active[channel]
+            hostname = state['hostname']
+
+            if channel in readable or channel.exit_status_ready():
+                while channel.recv_ready():
+                    state['stdout'] = flushLines(hostname, state['stdout'] + channel.recv(READ_SIZE), sys.stdout)
+                while channel.recv_stderr_ready():
+                    state['stderr'] = flushLines(hostname, state['stderr'] + channel.recv_stderr(READ_SIZE), sys.stderr)
+
+            if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                flushLines(hostname, state['stdout'], sys.stdout, final=True)
+                flushLines(hostname, state['stderr'], sys.stderr, final=True)
+                statuses[hostname] = channel.recv_exit_status()
+                channel.close()
+                del active[channel]
+            elif timeout is not None and time.time() - state['started'] > timeout:
+                flushLines(hostname, state['stdout'], sys.stdout, final=True)
+                flushLines(hostname, state['stderr'], sys.stderr, final=True)
+                print(hostname + ' | timed out after ' + str(timeout) + 's', file=sys.stderr, flush=True)
+                statuses[hostname] = STATUS_FAILED
+                channel.close()
+                del active[channel]
+
+    return statuses
+
+# run command on one host, streaming its output; returns the exit status
+def runOnHost(g, hostname, command, timeout=None):
+    return runOnHosts(g, [hostname], command, timeout=timeout)[hostname]
+
+# Run command on every host in the output file (deploy.py exec), then print a summary.
+#  Returns the number of hosts where it failed.
+def execOnFleet(g, command, max_concurrency=10, timeout=None):
+    hostnames = [host['public_dns'] for host in getStateStore(g).load().get('ec2_instances', [])]
+    if not hostnames:
+        print('no deployed hosts found')
+        return 0
+
+    started = time.time()
+    statuses = runOnHosts(g, hostnames, command, max_concurrency, timeout)
+
+    failed = [hostname for hostname in hostnames if statuses.get(hostname) != 0]
+    print()
+    print(str(len(hostnames) - len(failed)) + '/' + str(len(hostnames)) + ' hosts succeeded in ' + '{:.1f}'.format(time.time() - started) + 's')
+    for hostname in failed:
+        print('  ' + hostname + ': exit status ' + str(statuses.get(hostname)))
+    return len(failed)
@@ -0,0 +1,38 @@
+import time, random
+
+from botocore.exceptions import ClientError
+
+
+# get the error code of a botocore ClientError (None for any other exception)
+def getErrorCode(e):
+    if isinstance(e, ClientError):
+        return e.response.get('Error', {}).get('Code')
+    return None
+
+# get the error message of a botocore ClientError ('' for any other exception)
+def getErrorMessage(e):
+    if isinstance(e, ClientError):
+        return e.response.get('Error', {}).get('Message', '')
+    return ''
+
+### NOTE: the sleep before attempt n is a random value in [0, min(cap, base * 2**n)]
+##    ("full jitter"), so concurrent callers don't retry in lock step.
+#
+# Call fn until it returns. Exceptions for which is_retryable(e) is True are retried
+#  with exponential backoff until deadline_seconds have passed, anything else is raised.
+def retryWithBackoff(fn, is_retryable, description, base=1, cap=20, deadline_seconds=300):
+    deadline = time.time() + deadline_seconds
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            delay = random.uniform(0, min(cap, base * 2 ** attempt))
+            if time.time() + delay > deadline:
+                print('  ' + description + ': giving up after ' + str(attempt + 1) + ' attempts')
+                raise
+            print('  ' + description + ': not ready (' + (getErrorCode(e) or type(e).__name__) + '), retrying in ' + '{:.1f}'.format(delay) + 's')
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,116 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+### NOTE: a phase is a plain dict:
+##    name    ==> unique phase name (used in 'after' and in the report)
+##    fn      ==> callable taking g
+##    inputs  ==> keys of g['deployed'] the phase reads
+##    outputs ==> keys of g['deployed'] the phase writes
+##    after   ==> names of phases that must finish first (ordering without data)
+def phase(name, fn, inputs=None, outputs=None, after=None):
+    return {
+        'name': name,
+        'fn': fn,
+        'inputs': inputs or [],
+        'outputs': outputs or [],
+        'after': after or []
+    }
+
+# map each phase name to the set of phase names it depends on
+def getDependencies(g, phases):
+    producers = {}
+    for p in phases:
+        for key in p['outputs']:
+            producers[key] = p['name']
+
+    names = [p['name'] for p in phases]
+    dependencies = {}
+    for p in phases:
+        dependencies[p['name']] = set()
+        for key in p['inputs']:
+            if key in producers:
+                dependencies[p['name']].add(producers[key])
+            elif key not in g['deployed']:
+                raise ValueError('phase ' + p['name'] + ' reads \'' + key + '\' but no phase writes it')
+        for name in p['after']:
+            if name not in names:
+                raise ValueError('phase ' + p['name'] + ' runs after unknown phase ' + name)
+            dependencies[p['name']].add(name)
+        dependencies[p['name']].discard(p['name'])
+    return dependencies
+
+# walk back from the last phase to finish, following the dependency that finished last
+def getCriticalPath(dependencies, timings):
+    if not timings:
+        return []
+
+    current = max(timings, key=lambda name: timings[name]['end'])
+    path = [current]
+    while dependencies[current]:
+        current = max(dependencies[current], key=lambda name: timings[name]['end'])
+        path.insert(0, current)
+    return path
+
+# print the critical path (phase, duration) and the total wall clock time
+def printCriticalPath(dependencies, timings):
+    path = getCriticalPath(dependencies, timings)
+    if not path:
+        return
+
+    print('critical path:')
+    for name in path:
+        duration = timings[name]['end'] - timings[name]['start']
+        print('  ' + name + ' (' + '{:.1f}'.format(duration) + 's)')
+    print('total: ' + '{:.1f}'.format(timings[path[-1]]['end']) + 's')
+    print()
+
+# Run phases concurrently (bounded by max_workers) as soon as their inputs are written.
+#  The first failure stops new phases from being started and is re-raised once
+#  the running phases have finished.
+def runPhases(g, phases, max_workers=4):
+    dependencies = getDependencies(g, phases)
+    by_name = {p['name']: p for p in phases}
+
+    pending = set(by_name)
+    done = set()
+    running = {}
+    timings = {}
+    error = None
+    started = time.time()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if error is None:
+                for name in sorted(pending):
+                    if dependencies[name] <= done:
+                        pending.discard(name)
+                        timings[name] = {'start': time.time() - started}
+                        running[executor.submit(by_name[name]['fn'], g)] = name
+
+            if not running:
+                if error is None:
+                    raise ValueError('phases have a dependency cycle: ' + ', '.join(sorted(pending)))
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                timings[name]['end'] = time.time() - started
+                try:
+                    future.result()
+                except BaseException as e:
+                    if error is None:
+                        error = e
+                    continue
+
+                missing = [key for key in by_name[name]['outputs'] if key not in g['deployed']]
+                if missing and error is None:
+                    error = ValueError('phase ' + name + ' did not write ' + ', '.join(missing))
+                done.add(name)
+
+    print()
+    printCriticalPath(dependencies, {name: t for name, t in timings.items() if 'end' in t})
+
+    if error is not None:
+        raise error
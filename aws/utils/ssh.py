@@ -1,14 +1,17 @@
-import os, sys, io, time
-from threading import Thread
+import os, sys, shlex, uuid
 from pprint import pprint
-import paramiko
+
+from aws.utils.utils import updateDeployed, startBackgroundTask
+from aws.utils.keygen import getKeySpec, generateKeys, takePooledKey, refillKeyPool
+from aws.utils.sshpool import getParamikoSSHClient
+from aws.utils.remote import runOnHost
 
 ### NOTE: keypair (name) and key(file)name should be the same.
 ##   If the key pair is for the admin key, use create_key_pair method from boto3
-## else use paramiko's RSAKey.generate. 
+## else the key is generated locally (see aws/utils/keygen.py) and passed in.
 ### NOTE: create_key_pair from boto3 returns the private key, but provides no 
 ###    convenient way to get the public key.
-def create_key_pair(path, keypair, is_admin, session):
+def create_key_pair(path, keypair, is_admin, clients, generated_key=None):
     ssh_keys_path = path
 
     # if key exists do nothing
@@ -18,23 +21,11 @@ def create_key_pair(path, keypair, is_admin, session):
     else:
         # admin key is created via aws
         if is_admin:
-            key_pair = session.client('ec2').create_key_pair(KeyName=keypair)
+            key_pair = clients.client('ec2').create_key_pair(KeyName=keypair)
             private_key = key_pair["KeyMaterial"]
-        # user key is created via paramiko
+        # user key was generated (or drawn from the key pool) by createSshKeys
         else:
-            key = paramiko.RSAKey.generate(4096)
-            # print public key
-            #print(key.get_base64())
-            public_key = key.get_base64()
-            
-            # print private key
-            #key.write_private_key(sys.stdout)
-        
-            out = io.StringIO()
-            key.write_private_key(out)
-            #print(out.getvalue())
-
-            private_key = out.getvalue()
+            private_key, public_key = generated_key
     
     # if host os is windows
     if os.name == 'nt':
@@ -58,10 +49,10 @@ def create_key_pair(path, keypair, is_admin, session):
 
 # Deletes admin key via boto3's delete_key_pair, and 
 #  directly deletes the .pem and .pub files for user keys.
-def delete_key_pair(path, keypair, session):
+def delete_key_pair(path, keypair, clients):
     ssh_keys_path = path
 
-    response = session.client('ec2').delete_key_pair(KeyName=keypair)
+    response = clients.client('ec2').delete_key_pair(KeyName=keypair)
     
     if os.path.exists(ssh_keys_path + keypair):
         os.remove(ssh_keys_path + keypair)
@@ -69,20 +60,58 @@ def delete_key_pair(path, keypair, session):
     if os.path.exists(ssh_keys_path + keypair.replace('.pem','.pub')):
         os.remove(ssh_keys_path + keypair.replace('.pem','.pub'))
 
+# get the root of the key pool (ssh_keys/pool), holding one directory per key spec
+def getKeyPoolRoot(g):
+    return g['config']['ssh_keys']['directory'] + os.sep + 'pool'
+
+# top the key pool back up to ssh_keys.pool_size for every key spec in config
+def refillKeyPoolFromConfig(g):
+    config = g['config']
+    specs = [getKeySpec(user['ssh_key']) for user in config['server']['users']]
+    refillKeyPool(getKeyPoolRoot(g), specs, config['ssh_keys'].get('pool_size', 0),
+        config['ssh_keys'].get('max_workers'))
+
 # Iterates over admin and users and creates their respective keypairs.
+#  User keys are drawn from the key pool when possible, the rest are generated
+#  on a process pool (ssh_keys.max_workers).
 def createSshKeys(g):
     config = g['config']
     
     ssh_keys_directory = config['ssh_keys']['directory'] + os.sep
     admin_keyfile = config['server']['admin']['ssh_key']['name']
+    pool_size = config['ssh_keys'].get('pool_size', 0)
 
     IS_ADMIN_KEY = True
     NOT_ADMIN_KEY = False
 
-    create_key_pair(ssh_keys_directory, admin_keyfile, IS_ADMIN_KEY, g['session'])
-    
-    for user in config['server']['users']:
-        create_key_pair(ssh_keys_directory, user['ssh_key']['name'], NOT_ADMIN_KEY, g['session'])
+    create_key_pair(ssh_keys_directory, admin_keyfile, IS_ADMIN_KEY, g['clients'])
+
+    # users without a key yet, and their key (algorithm, bits)
+    missing = [user for user in config['server']['users'] if not os.path.exists(ssh_keys_directory + user['ssh_key']['name'])]
+    specs = [getKeySpec(user['ssh_key']) for user in missing]
+
+    generated_keys = [None] * len(missing)
+    if pool_size:
+        for i, spec in enumerate(specs):
+            generated_keys[i] = takePooledKey(getKeyPoolRoot(g), spec)
+
+    to_generate = [i for i, key in enumerate(generated_keys) if key is None]
+    if to_generate:
+        print('generating ' + str(len(to_generate)) + ' ssh keys')
+        keys = generateKeys([specs[i] for i in to_generate], config['ssh_keys'].get('max_workers'))
+        for i, key in zip(to_generate, keys):
+            generated_keys[i] = key
+
+    for user, generated_key in zip(missing, generated_keys):
+        create_key_pair(ssh_keys_directory, user['ssh_key']['name'], NOT_ADMIN_KEY, g['clients'], generated_key)
+
+    if pool_size:
+        startBackgroundTask(g, 'refill ssh key pool', refillKeyPoolFromConfig)
+
+    # record key files (the admin key pair name is needed by run_instances)
+    changes = {}
+    changes['ssh_keys'] = [admin_keyfile] + [user['ssh_key']['name'] for user in config['server']['users']]
+    updateDeployed(g, changes)
 
 # Iterates over admin and users and deletes their respective keypairs.
 def deleteSshKeys(g):
@@ -91,40 +120,10 @@ def deleteSshKeys(g):
     ssh_keys_directory = config['ssh_keys']['directory'] + os.sep
     admin_keyfile = config['server']['admin']['ssh_key']['name']
 
-    delete_key_pair(ssh_keys_directory, admin_keyfile, g['session'])
+    delete_key_pair(ssh_keys_directory, admin_keyfile, g['clients'])
     
     for user in config['server']['users']:
-        delete_key_pair(ssh_keys_directory, user['ssh_key']['name'], g['session'])
-
-
-# create and return a successfully connected ssh client (paramiko)
-def getParamikoSSHClient(g, hostname):
-    # get private key full path from config
-    private_key_file = g['config']['server']['admin']['ssh_key']['name']
-    ssh_keys_directory = g['root_path'] + g['config']['ssh_keys']['directory']
-    private_key_full_path =  ssh_keys_directory + os.sep + private_key_file
-
-    # admin is the default sudo user for ec2 instances
-    admin_username = g['config']['server']['admin']['login']
-
-    # read private key from file, as string
-    private_key_string = open(private_key_full_path,'r').read()
-
-    # convert private key into _ for paramiko
-    pkey = io.StringIO()
-    pkey.write(private_key_string)
-    pkey.seek(0)
-    k = paramiko.RSAKey.from_private_key(pkey)
-    
-    # initialize ssh client
-    ssh_client = paramiko.SSHClient()
-    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    # connect ssh client to instance
-    ssh_client.connect(hostname=hostname, username=admin_username, pkey=k)
-    print()
-    print('connecting to ' + admin_username + '@' + hostname)
-
-    return ssh_client
+        delete_key_pair(ssh_keys_directory, user['ssh_key']['name'], g['clients'])
 
 
 ### NOTE: a temporary plaintext password is used (see config.yaml) for admin account, but 
@@ -134,77 +133,116 @@ def getParamikoSSHClient(g, hostname):
 #  public keys for (non-admin) users to their respective ~/.ssh/authorized_keys file. 
 def send_key(g, public_key_path, hostname, user):
     if os.path.exists(public_key_path):
-        public_key_string = open(public_key_path,'r').read()
+        key_line = getAuthorizedKeyLine(public_key_path, user)
     else:
         print('public key not found')
 
-    connected_client = getParamikoSSHClient(g, hostname)
-    
     temp_password = g['config']['server']['admin']['initial_sudo_password']
-    cmd = 'echo ' + temp_password + ' | sudo -S -k bash -c \'echo ' + temp_password + ' | sudo -S -k echo ssh-rsa ' + public_key_string + ' ' + user + '-key.pem' + ' >> /home/' + user + '/.ssh/authorized_keys\''
+    cmd = 'echo ' + temp_password + ' | sudo -S -k bash -c \'echo ' + temp_password + ' | sudo -S -k echo ' + key_line + ' >> /home/' + user + '/.ssh/authorized_keys\''
     #print(cmd)
     print('  copying public key for ' + user + ' to ~/.ssh/authorized_keys')
 
-    (stdin, stdout, stderr) = connected_client.exec_command(cmd)
+    # stream stdout/stderr (see aws/utils/remote.py)
     print()
-    if stdout:
-        for line in stdout.readlines():
-            print('    ' + line)
-    '''if stderr:
-        for line in stderr.readlines():
-            print('    ' + line)'''
-    
-    connected_client.close()
+    if runOnHost(g, hostname, cmd) != 0:
+        raise RuntimeError('copying public key for ' + user + ' to ' + hostname + ' failed')
+
+# get the authorized_keys line for a user's public key file. The .pub file holds
+#  '<type> <base64>' (keygen.py) or, for keys written by older versions, the base64 rsa key only.
+def getAuthorizedKeyLine(public_key_path, user):
+    with open(public_key_path, 'r') as handle:
+        public_key_string = handle.read().strip()
+    if ' ' in public_key_string:
+        public_key_string = ' '.join(public_key_string.split()[:2])
+    else:
+        public_key_string = 'ssh-rsa ' + public_key_string
+    return public_key_string + ' ' + user + '-key.pem'
+
+# remote script (run as root) installing every user's keys. Keys already present are
+#  kept, duplicates are dropped, and each authorized_keys is replaced atomically (mv).
+AUTHORIZED_KEYS_SCRIPT_HEADER = """set -e
+install_keys () {
+    dir=/home/$1/.ssh
+    mkdir -p "$dir"
+    tmp=$(mktemp "$dir/.authorized_keys.XXXXXX")
+    { cat "$dir/authorized_keys" 2>/dev/null || true; printf '%s\\n' "$2"; } | awk 'NF && !seen[$0]++' > "$tmp"
+    chmod 600 "$tmp"
+    chown "$1:$1" "$tmp"
+    chmod 700 "$dir"
+    chown "$1:$1" "$dir"
+    mv -f "$tmp" "$dir/authorized_keys"
+}
+"""
+
+# build the remote script installing the keys of every (non-admin) user
+def getAuthorizedKeysScript(g):
+    lines = [AUTHORIZED_KEYS_SCRIPT_HEADER]
+    for user in g['config']['server']['users']:
+        key_line = getAuthorizedKeyLine(getPublicKeyPath(g, user), user['login'])
+        lines.append('install_keys ' + shlex.quote(user['login']) + ' ' + shlex.quote(key_line))
+    return '\n'.join(lines) + '\n'
+
+### NOTE: the whole payload is uploaded once over sftp and applied by a single
+##    sudo exec, so the number of remote commands per host does not grow with
+##    the number of users. Reruns don't append duplicate keys.
+#
+# Copy the public keys of every (non-admin) user to one host in a single push.
+def send_keys_bulk(g, hostname):
+    connected_client = getParamikoSSHClient(g, hostname)
+    script_path = '.authorized-keys-' + uuid.uuid4().hex + '.sh'
+
+    sftp = connected_client.open_sftp()
+    try:
+        with sftp.open(script_path, 'w') as handle:
+            handle.write(getAuthorizedKeysScript(g))
+    finally:
+        sftp.close()
+
+    temp_password = g['config']['server']['admin']['initial_sudo_password']
+    cmd = 'echo ' + temp_password + ' | sudo -S -k bash ' + script_path + '; status=$?; rm -f ' + script_path + '; exit $status'
+    print('  copying public keys for ' + str(len(g['config']['server']['users'])) + ' users to ~/.ssh/authorized_keys')
+
+    # stream stdout/stderr (see aws/utils/remote.py)
+    if runOnHost(g, hostname, cmd) != 0:
+        raise RuntimeError('installing public keys on ' + hostname + ' failed')
 
 #  Uses paramiko ssh client to connect (as admin user) and run a bash shell command to force
 #  admin user password change on next ssh login.
-def force_admin_pass_change(g, hostname):
+def expire_admin_password(g, hostname):
     admin_username = g['config']['server']['admin']['login']
-    connected_client = getParamikoSSHClient(g, hostname)
 
     temp_password = g['config']['server']['admin']['initial_sudo_password']
     print('  forcing (sudo) password reset for ' + admin_username + ' on next ssh login')
     print()
 
+    cmd = 'echo ' + temp_password + ' | sudo -S passwd --expire admin'
+    # stream stdout/stderr (see aws/utils/remote.py)
+    if runOnHost(g, hostname, cmd) != 0:
+        raise RuntimeError('expiring admin password on ' + hostname + ' failed')
+
+#  Uses paramiko ssh client to connect (as admin user) and start a yum update in the background.
+def start_yum_update(g, hostname):
+    connected_client = getParamikoSSHClient(g, hostname)
+
+    temp_password = g['config']['server']['admin']['initial_sudo_password']
+
     # run a yum update in background and continue upon logout
     cmd2 = 'nohup echo ' + temp_password + ' | sudo -S -k bash -c \'echo ' + temp_password + ' | sudo -S -k yum update &'
 
-    cmd = 'echo ' + temp_password + ' | sudo -S passwd --expire admin'
-    (stdin, stdout, stderr) = connected_client.exec_command(cmd)
-    if stdout:
-        for line in stdout.readlines():
-            print('    ' + line)
-    '''if stderr:
-        for line in stderr.readlines():
-            print('    ' + line)'''
-    
     # run yum update
     connected_client.exec_command(cmd2)
-    
-    connected_client.close()
 
-# iterate over (non-admin) users and call send_key for each respective public key
-def sendKeys(g):
+# get full path of a user's public key file
+def getPublicKeyPath(g, user):
     ssh_keys_directory = g['root_path'] + g['config']['ssh_keys']['directory']
-    for host in g['deployed']['ec2_instances']:
-        hostname = host['public_dns']
-
-        print('sending public keys for users to server...')
+    public_key_file_name = user['ssh_key']['name'].replace('pem', 'pub')
+    return ssh_keys_directory + os.sep + public_key_file_name
+
+# send the public key of every (non-admin) user to one host
+#  (server.provisioning.key_distribution: bulk (default) or per_user)
+def sendUserKeys(g, hostname):
+    if g['config']['server'].get('provisioning', {}).get('key_distribution', 'bulk') == 'bulk':
+        send_keys_bulk(g, hostname)
+    else:
         for user in g['config']['server']['users']:
-            user_login_name = user['login']
-            public_key_file_name = user['ssh_key']['name'].replace('pem', 'pub')
-            public_key_full_path = ssh_keys_directory + os.sep + public_key_file_name
-            
-            attempts = 0
-            while(attempts < 15):
-                try:
-                    send_key(g, public_key_full_path, hostname, user_login_name)
-                    break
-                except Exception:
-                     print('  server must not be ready yet, retrying...')
-                     time.sleep(12)
-                     attempts += 1
-                    
-                    
-            
-            
+            send_key(g, getPublicKeyPath(g, user), hostname, user['login'])
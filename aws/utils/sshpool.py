@@ -0,0 +1,110 @@
+import os, io, threading
+
+import paramiko
+
+
+### NOTE: one authenticated ssh transport is kept per host for the whole run.
+##    Every command opens a new channel on it (exec_command), so a host costs one
+##    tcp+ssh handshake no matter how many commands are run on it. The admin
+##    private key is read and parsed once.
+#
+# Pool of connected (admin) ssh clients, one per host.
+class SSHPool:
+    def __init__(self, g):
+        self.g = g
+        self.clients = {}
+        self.pkey = None
+        self._lock = threading.Lock()
+        self._host_locks = {}
+
+        ssh_config = g['config'].get('ssh', {})
+        self.keepalive_seconds = ssh_config.get('keepalive_seconds', 30)
+        self.connect_timeout = ssh_config.get('connect_timeout', 10)
+
+    # read and parse the admin private key (only the first time)
+    def getPrivateKey(self):
+        with self._lock:
+            if self.pkey is None:
+                # get private key full path from config
+                private_key_file = self.g['config']['server']['admin']['ssh_key']['name']
+                ssh_keys_directory = self.g['root_path'] + self.g['config']['ssh_keys']['directory']
+                private_key_full_path =  ssh_keys_directory + os.sep + private_key_file
+
+                # read private key from file, as string
+                with open(private_key_full_path, 'r') as handle:
+                    private_key_string = handle.read()
+
+                # convert private key into _ for paramiko
+                self.pkey = paramiko.RSAKey.from_private_key(io.StringIO(private_key_string))
+            return self.pkey
+
+    def getHostLock(self, hostname):
+        with self._lock:
+            return self._host_locks.setdefault(hostname, threading.Lock())
+
+    # check that a pooled client's transport is still usable
+    def isHealthy(self, ssh_client):
+        transport = ssh_client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    # get the pooled client for hostname, connecting (again) if there is none or it went stale
+    def get(self, hostname):
+        with self.getHostLock(hostname):
+            ssh_client = self.clients.get(hostname)
+            if ssh_client is not None and self.isHealthy(ssh_client):
+                return ssh_client
+            if ssh_client is not None:
+                ssh_client.close()
+
+            # admin is the default sudo user for ec2 instances
+            admin_username = self.g['config']['server']['admin']['login']
+
+            # initialize ssh client
+            ssh_client = paramiko.SSHClient()
+            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            # connect ssh client to instance
+            ssh_client.connect(hostname=hostname, username=admin_username, pkey=self.getPrivateKey(),
+                timeout=self.connect_timeout, allow_agent=False, look_for_keys=False)
+            ssh_client.get_transport().set_keepalive(self.keepalive_seconds)
+            print()
+            print('connecting to ' + admin_username + '@' + hostname)
+
+            self.clients[hostname] = ssh_client
+            return ssh_client
+
+    # drop (and close) the client for hostname, eg. after a failed command
+    def discard(self, hostname):
+        with self.getHostLock(hostname):
+            ssh_client = self.clients.pop(hostname, None)
+            if ssh_client is not None:
+                ssh_client.close()
+
+    def closeAll(self):
+        with self._lock:
+            hostnames = list(self.clients)
+        for hostname in hostnames:
+            self.discard(hostname)
+
+POOL_LOCK = threading.Lock()
+
+# get this run's ssh pool (created on first use)
+def getSSHPool(g):
+    with POOL_LOCK:
+        if 'ssh_pool' not in g:
+            g['ssh_pool'] = SSHPool(g)
+    return g['ssh_pool']
+
+# close every pooled ssh connection (end of run)
+def closeSSHPool(g):
+    if 'ssh_pool' in g:
+        g['ssh_pool'].closeAll()
+
+# return a successfully connected (pooled) ssh client (paramiko)
+def getParamikoSSHClient(g, hostname):
+    return getSSHPool(g).get(hostname)
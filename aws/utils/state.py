@@ -0,0 +1,222 @@
+import os, json, sqlite3, tempfile, threading
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+
+### NOTE: the lock file sits next to the state file (eg. deployed.json.lock),
+##    so two runs against the same state never write at the same time.
+#
+# Exclusive, cross-process lock held for the duration of a write.
+class FileLock:
+    def __init__(self, path):
+        self.path = path + '.lock'
+        self.handle = None
+
+    def __enter__(self):
+        self.handle = open(self.path, 'a+')
+        if os.name == 'nt':
+            self.handle.seek(0)
+            msvcrt.locking(self.handle.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(self.handle.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if os.name == 'nt':
+            self.handle.seek(0)
+            msvcrt.locking(self.handle.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self.handle.fileno(), fcntl.LOCK_UN)
+        self.handle.close()
+        self.handle = None
+
+# Write content to a temp file in the same directory, then rename it over path.
+#  Readers see either the old or the new file, never a missing or partial one.
+#  content can be text or bytes.
+def atomicWrite(path, content):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(content, bytes) else 'w') as handle:
+            handle.write(content)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+# pretty-printed, key-sorted json (the format of the output file)
+def toJson(deployed):
+    return json.dumps(deployed, indent=4, sort_keys=True)
+
+
+### NOTE: both stores follow the same rules: an update replaces only the top-level
+##    keys in changes, and keys stored by earlier runs (eg. baked_images, warm_pool,
+##    launch_template) are kept until a run changes them or the state is cleared.
+##    The first update of a run also stores keys set on deployed directly (eg. iam_user).
+#
+# State kept directly in the output file, rewritten atomically on every update.
+class JsonStateStore:
+    def __init__(self, path):
+        self.path = path
+        self.synced = False
+        self._lock = threading.Lock()
+
+    # read the stored state ({} if there is none)
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as handle:
+            return json.load(handle)
+
+    # merge the changed keys into the stored state and rewrite the file
+    def update(self, deployed, changes):
+        if not self.synced:
+            changes = dict(deployed)
+            self.synced = True
+
+        with self._lock, FileLock(self.path):
+            stored = self.load()
+            stored.update(changes)
+            atomicWrite(self.path, toJson(stored))
+
+    # the state file is the output file, so export only needs a different target
+    def export(self, path):
+        if os.path.abspath(path) != os.path.abspath(self.path):
+            atomicWrite(path, toJson(self.load()))
+
+    def clear(self):
+        with self._lock, FileLock(self.path):
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        self.synced = False
+
+
+### NOTE: every top-level key of deployed is stored as its own row, and keys holding
+##    resources are split further, so an update only writes the resources that changed:
+##      subnets        ==> one row per subnet ('subnets/subnet-0abc': az, cidr) and one
+##                         per instance in it ('subnets/subnet-0abc/i-0def': volumes)
+##      ec2_instances  ==> one row per instance ('ec2_instances/i-0def'); the parent
+##                         row holds the instance ids in order
+#
+# State kept in a sqlite database, one row per resource.
+class SqliteStateStore:
+    # dict keys split into one row per child dict, this many levels deep
+    SPLIT_KEYS = {'subnets': 2}
+    # list keys split into one row per item, named by the item's id field
+    LIST_KEYS = {'ec2_instances': 'id'}
+
+    def __init__(self, path):
+        self.path = path
+        self.synced = False
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS resources (key TEXT PRIMARY KEY, parent TEXT, value TEXT)')
+
+    # flatten one top-level key into {row_key: (parent, json value)}
+    def getRows(self, key, value):
+        if key in self.LIST_KEYS and isinstance(value, list) and all(self.LIST_KEYS[key] in item for item in value):
+            id_field = self.LIST_KEYS[key]
+            rows = {key: (None, json.dumps([item[id_field] for item in value]))}
+            for item in value:
+                rows[key + '/' + item[id_field]] = (key, json.dumps(item, sort_keys=True))
+            return rows
+        if key in self.SPLIT_KEYS and isinstance(value, dict):
+            return self.splitRows(key, None, value, self.SPLIT_KEYS[key])
+        return {key: (None, json.dumps(value, sort_keys=True))}
+
+    # split the dict values of value into their own rows (depth levels deep); everything
+    #  else stays in row_key's own row, which is kept even when empty (so {} round trips)
+    def splitRows(self, row_key, parent, value, depth):
+        rows = {}
+        own = {}
+        for child, child_value in value.items():
+            if depth > 0 and isinstance(child_value, dict):
+                rows.update(self.splitRows(row_key + '/' + child, row_key, child_value, depth - 1))
+            else:
+                own[child] = child_value
+        rows[row_key] = (parent, json.dumps(own, sort_keys=True))
+        return rows
+
+    # read the stored state ({} if there is none)
+    def load(self):
+        deployed = {}
+        items = {}
+        with self._lock:
+            rows = self.connection.execute('SELECT key, parent, value FROM resources').fetchall()
+
+        # parents before children
+        for key, parent, value in sorted(rows, key=lambda row: row[0].count('/')):
+            value = json.loads(value)
+            if parent is None:
+                deployed[key] = value
+            elif parent in self.LIST_KEYS:
+                items.setdefault(parent, {})[key[len(parent) + 1:]] = value
+            else:
+                container = deployed
+                for part in parent.split('/'):
+                    container = container.setdefault(part, {})
+                container[key[len(parent) + 1:]] = value
+
+        # rebuild list keys in the stored order
+        for key, by_id in items.items():
+            deployed[key] = [by_id[item_id] for item_id in deployed.get(key, []) if item_id in by_id]
+        return deployed
+
+    # upsert the rows of the changed keys whose value differs, delete the ones that are gone
+    def update(self, deployed, changes):
+        # the first update also stores keys set on deployed directly (eg. iam_user)
+        if not self.synced:
+            changes = dict(deployed)
+            self.synced = True
+
+        with self._lock, FileLock(self.path):
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                for key, value in changes.items():
+                    rows = self.getRows(key, value)
+                    cursor = self.connection.execute(
+                        'SELECT key, value FROM resources WHERE key = ? OR substr(key, 1, ?) = ?',
+                        (key, len(key) + 1, key + '/'))
+                    existing = dict(cursor.fetchall())
+
+                    for row_key in existing:
+                        if row_key not in rows:
+                            self.connection.execute('DELETE FROM resources WHERE key = ?', (row_key,))
+                    for row_key, (parent, row_value) in rows.items():
+                        if existing.get(row_key) != row_value:
+                            self.connection.execute(
+                                'INSERT OR REPLACE INTO resources (key, parent, value) VALUES (?, ?, ?)',
+                                (row_key, parent, row_value))
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    # generate the output file from the stored state
+    def export(self, path):
+        atomicWrite(path, toJson(self.load()))
+
+    def clear(self):
+        with self._lock, FileLock(self.path):
+            self.connection.execute('DELETE FROM resources')
+        self.synced = False
+
+
+# create the state store configured under output.backend (json or sqlite)
+def openStateStore(config):
+    output = config['output']
+    backend = output.get('backend', 'json')
+
+    if backend == 'json':
+        return JsonStateStore(output['file'])
+    elif backend == 'sqlite':
+        return SqliteStateStore(output.get('state_file', 'deployed.db'))
+    else:
+        raise ValueError('unknown output.backend: ' + str(backend))
@@ -1,8 +1,16 @@
 import os, json, yaml, boto3, sys
+from threading import Lock, Thread
 from pprint import pprint
 from yaml.loader import SafeLoader
 from dotenv import load_dotenv
 
+from aws.utils.clients import ClientRegistry
+from aws.utils.state import openStateStore
+
+# phases can run concurrently (see aws/utils/scheduler.py), so writes to the
+# deployed dict and output file are serialized
+DEPLOYED_LOCK = Lock()
+
 
 # load aws credentials from .env file
 def loadAwsCredentials(root_path, config):
@@ -18,9 +26,11 @@ def loadAwsCredentials(root_path, config):
         aws_session_token=os.getenv('AWS_SESSION_TOKEN'),
         region_name=os.getenv('AWS_REGION')
     )
-    iam_user = session.client('iam').get_user()
+    # shared, pooled clients/resources (see aws/utils/clients.py)
+    clients = ClientRegistry(session, config)
+    iam_user = clients.client('iam').get_user()
 
-    return session, region, iam_user['User']['UserName']
+    return session, clients, region, iam_user['User']['UserName']
 
 # Open the json file and return contents as dictionary
 def readFromFile(full_path):
@@ -45,27 +55,64 @@ def readFromConfig(path, configfile):
     
     return config
 
-# Delete output file if it exists
+# Get the path of a file (or directory) under cache.directory in config.yaml,
+#  creating the cache directory (and subdirectory) if needed.
+def getCachePath(g, name, subdirectory=None):
+    cache_directory = g['root_path'] + g['config'].get('cache', {}).get('directory', '.cache')
+    if subdirectory:
+        cache_directory += os.sep + subdirectory
+    if not os.path.exists(cache_directory):
+        os.makedirs(cache_directory, exist_ok=True)
+    return cache_directory + os.sep + name
+
+# Get the state store (see aws/utils/state.py), opening it on first use
+def getStateStore(g):
+    with DEPLOYED_LOCK:
+        if 'state' not in g:
+            g['state'] = openStateStore(g['config'])
+    return g['state']
+
+# Clear stored state and delete output file if it exists
 def clearDeployed(g):
     config = g['config']
 
+    getStateStore(g).clear()
+
     file = config['output']['file']
     if os.path.exists(file):
         os.remove(file)
+
+# Generate output file from stored state
+def exportDeployed(g):
+    getStateStore(g).export(g['config']['output']['file'])
     
-# Copy keys and values from changes dict to deployed dict and write to output file
+# Copy keys and values from changes dict to deployed dict and write them to the state store
 def updateDeployed(g, changes):
-    deployed = g['deployed']
-    deployed['region'] = g['config']['region']
-    config = g['config']
-    
-    deployed.update(changes)
-    
-    clearDeployed(g)
+    state = getStateStore(g)
 
-    output_file = config['output']['file']
-    with os.fdopen(os.open(output_file, os.O_WRONLY | os.O_CREAT), "w+") as handle:
-        handle.write(json.dumps(deployed, indent=4, sort_keys=True))
+    with DEPLOYED_LOCK:
+        deployed = g['deployed']
+        deployed['region'] = g['config']['region']
+        
+        deployed.update(changes)
+
+        changes = dict(changes)
+        changes['region'] = deployed['region']
+        state.update(deployed, changes)
     
     return deployed
 
+# Run fn(g) on a background thread; deploy.py waits for these at the end of a run.
+def startBackgroundTask(g, name, fn):
+    thread = Thread(target=fn, args=(g,), name=name)
+    with DEPLOYED_LOCK:
+        g.setdefault('background', []).append(thread)
+    thread.start()
+    return thread
+
+# wait for every background task started during this run
+def joinBackgroundTasks(g):
+    for thread in g.get('background', []):
+        if thread.is_alive():
+            print('waiting for background task: ' + thread.name)
+        thread.join()
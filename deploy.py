@@ -1,14 +1,38 @@
 import os, argparse, traceback, sys
 from pprint import pprint
-from aws.utils.utils import readFromConfig, loadAwsCredentials, clearDeployed
-from aws.resources.iam.iam import deleteInstanceProfile
+from aws.utils.utils import readFromConfig, loadAwsCredentials, clearDeployed, exportDeployed, joinBackgroundTasks, getStateStore
+from aws.utils.scheduler import phase, runPhases
+from aws.resources.iam.iam import createInstanceProfile, deleteInstanceProfile
 from aws.resources.vpc.vpc import createVPC, teardown
-from aws.utils.ssh import createSshKeys, deleteSshKeys, force_admin_pass_change, sendKeys
-from aws.resources.ec2.ec2 import createEc2Instances
+from aws.utils.ssh import createSshKeys, deleteSshKeys
+from aws.utils.sshpool import closeSSHPool
+from aws.utils.remote import execOnFleet
+from aws.resources.ec2.ec2 import createEc2Instances, lookupImage, probeInstanceProfile, bakeImage
+from aws.resources.ec2.bake import deleteBakedImages
+from aws.resources.ec2.template import deleteLaunchTemplate
 
 def run(root_path):
     config = readFromConfig(root_path, args.filename)
-    session, region, iam_user = loadAwsCredentials(root_path, config)
+
+    # regenerate output file from stored state, without touching aws
+    if args.export:
+        exportDeployed({'config': config})
+        return
+
+    # run a command on every deployed host (ssh only, no aws calls)
+    if args.mode == 'exec':
+        if not args.command:
+            parser.error('exec needs a command')
+        g = {'root_path': root_path, 'config': config, 'deployed': {}}
+        try:
+            failed = execOnFleet(g, args.command, args.max_concurrency, args.timeout)
+        finally:
+            closeSSHPool(g)
+        if failed:
+            sys.exit(1)
+        return
+
+    session, clients, region, iam_user = loadAwsCredentials(root_path, config)
 
     g = {}
     g['root_path'] = root_path
@@ -17,34 +41,84 @@ def run(root_path):
     g['deployed'] = {}
     g['deployed']['iam_user'] = iam_user
     g['session'] = session
+    g['clients'] = clients
+    # command line switches read by phases
+    g['options'] = {}
+    g['options']['refresh_ami'] = args.refresh_ami
 
-    print()
-    if args.destroy:
-        teardown(g)
-        deleteInstanceProfile(g)
-        deleteSshKeys(g)
-        clearDeployed(g)
-    else:
-        createSshKeys(g)
-        createVPC(g)
-        createEc2Instances(g)
-        sendKeys(g)
-        # expire admin (sudo) password/force change on next login
-        for host in g['deployed']['ec2_instances']:
-            hostname = host['public_dns']
-            force_admin_pass_change(g, hostname)
-        
-        # print ssh info
-        for instance in g['deployed']['ec2_instances']:
-            for cmd in instance['ssh']:
-                print(cmd)
-            print()
+    # images baked by earlier runs (deploy.py bake), read before any phase runs
+    if not args.destroy:
+        baked_images = getStateStore(g).load().get('baked_images')
+        if baked_images:
+            g['deployed']['baked_images'] = baked_images
+
+    # max number of phases run at the same time
+    max_workers = config.get('scheduler', {}).get('max_workers', 4)
+
+    try:
+        print()
+        if args.destroy:
+            runPhases(g, [
+                phase('teardown', teardown),
+                phase('deleteInstanceProfile', deleteInstanceProfile),
+                phase('deleteSshKeys', deleteSshKeys),
+                phase('deleteLaunchTemplate', deleteLaunchTemplate),
+                phase('deleteBakedImages', deleteBakedImages),
+            ], max_workers)
+            clearDeployed(g)
+        elif args.mode == 'bake':
+            runPhases(g, [
+                phase('createSshKeys', createSshKeys, outputs=['ssh_keys']),
+                phase('createVPC', createVPC, outputs=['vpc_id', 'vpc_cidr', 'subnets', 'sg_id']),
+                phase('createInstanceProfile', createInstanceProfile, outputs=['instance_profile']),
+                phase('lookupImage', lookupImage, outputs=['image_id']),
+                phase('probeInstanceProfile', probeInstanceProfile,
+                    inputs=['instance_profile', 'image_id', 'subnets', 'sg_id']),
+                # launches one instance with the full userdata and saves it as an image
+                phase('bakeImage', bakeImage,
+                    inputs=['ssh_keys', 'vpc_id', 'subnets', 'sg_id', 'instance_profile', 'image_id'],
+                    outputs=['baked_images'], after=['probeInstanceProfile']),
+            ], max_workers)
+        else:
+            runPhases(g, [
+                phase('createSshKeys', createSshKeys, outputs=['ssh_keys']),
+                phase('createVPC', createVPC, outputs=['vpc_id', 'vpc_cidr', 'subnets', 'sg_id']),
+                phase('createInstanceProfile', createInstanceProfile, outputs=['instance_profile']),
+                phase('lookupImage', lookupImage, outputs=['image_id']),
+                # launch as soon as ec2 can see the (new) instance profile
+                phase('probeInstanceProfile', probeInstanceProfile,
+                    inputs=['instance_profile', 'image_id', 'subnets', 'sg_id']),
+                # launches and provisions (keys, admin password expiry, yum update) each host
+                phase('createEc2Instances', createEc2Instances,
+                    inputs=['ssh_keys', 'vpc_id', 'subnets', 'sg_id', 'instance_profile', 'image_id'],
+                    outputs=['ec2_instances'], after=['probeInstanceProfile']),
+            ], max_workers)
+
+            # print ssh info
+            for instance in g['deployed']['ec2_instances']:
+                for cmd in instance['ssh']:
+                    print(cmd)
+                print()
+    finally:
+        joinBackgroundTasks(g)
+        # write output file from stored state (also when a phase failed part way)
+        if not args.destroy and 'state' in g:
+            exportDeployed(g)
+        closeSSHPool(g)
+        clients.report()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Deploy EC2 instance from yaml file configuration.')
     parser.add_argument('filename',
                     help='A yaml configuration file within the same directory.')
+    parser.add_argument('mode', nargs='?', choices=['deploy', 'exec', 'bake'], default='deploy',
+                    help='deploy (default), exec to run a command on every deployed host, or bake an image from the config.')
+    parser.add_argument('command', nargs='?', help='Command run by exec.')
     parser.add_argument("--destroy", action='store_true', help="Teardown all resources.")
+    parser.add_argument("--refresh-ami", action='store_true', help="Ignore the cached AMI id and look up the latest AMI.")
+    parser.add_argument("--export", action='store_true', help="Write output file from stored state and exit.")
+    parser.add_argument("--max-concurrency", type=int, default=10, help="Hosts exec runs on at the same time.")
+    parser.add_argument("--timeout", type=float, default=None, help="Seconds before exec gives up on a host.")
     args = parser.parse_args()
 
     if args.filename: